@@ -1,8 +1,16 @@
+import os
+import sys
+import copy
+import time
+import hashlib
+import argparse
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.transforms as transforms
 import torchvision.datasets as dataset
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 import torch.nn as nn
 import torch.optim as optim
 
@@ -90,50 +98,328 @@ transform = transforms.Compose([
 train_path = "Train"
 test_path  = "Test"
 
-train_data = dataset.ImageFolder(train_path, transform)
-test_data = dataset.ImageFolder(test_path, transform)
+# ResNet50 с замороженными весами и трехслойной головой на 7 классов
+def build_model(num_classes=7, pretrained=True):
+    pretrained_resnet101 = models.resnet50(pretrained=pretrained)
 
-train_loader_1 = DataLoader(train_data, batch_size=16, shuffle=True)
-test_loader_1  = DataLoader(train_data, batch_size=16, shuffle=True)
+    for name, param in pretrained_resnet101.named_parameters():
+        param.requires_grad = False
 
-pretrained_resnet101 = models.resnet50(pretrained=True)
+    pretrained_resnet101.fc = nn.Sequential(
+        nn.Linear(pretrained_resnet101.fc.in_features, 1024),  # Увеличенная размерность
+        nn.BatchNorm1d(1024),  # Нормализация для стабилизации обучения
+        nn.ReLU(inplace=True),
+        nn.Dropout(p=0.5),  # Явное указание вероятности
 
-for name, param in pretrained_resnet101.named_parameters():
-    param.requires_grad = False
+        nn.Linear(1024, 512),  # Промежуточный слой
+        nn.BatchNorm1d(512),
+        nn.ReLU(inplace=True),
+        nn.Dropout(p=0.3),  # Меньший dropout для deeper слоев
 
-pretrained_resnet101.fc = nn.Sequential(
-    nn.Linear(pretrained_resnet101.fc.in_features, 1024),  # Увеличенная размерность
-    nn.BatchNorm1d(1024),  # Нормализация для стабилизации обучения
-    nn.ReLU(inplace=True),
-    nn.Dropout(p=0.5),  # Явное указание вероятности
-    
-    nn.Linear(1024, 512),  # Промежуточный слой
-    nn.BatchNorm1d(512),
-    nn.ReLU(inplace=True),
-    nn.Dropout(p=0.3),  # Меньший dropout для deeper слоев
-    
-    nn.Linear(512, 7)  # Финальный слой с 7 классами
-)
-pretrained_resnet101.to(device)
-
-# попробуем обучить!
-
-epochs = 25
-optimizer = optim.Adam(pretrained_resnet101.parameters(), lr=0.001)
-loss_function = nn.CrossEntropyLoss()
-best_loss = 1000000
-best_acc = 0
-for epoch in range(epochs):
-    
-    train_loss, train_acc = train(pretrained_resnet101, train_loader_1, optimizer, loss_function, device)
+        nn.Linear(512, num_classes)  # Финальный слой с 7 классами
+    )
+    return pretrained_resnet101
+
+# Сохранение лучшей модели: целиком (для дообучения, квантования и экспорта) и трассированной
+# в TorchScript рядом с ней (*.jit.pt, бэкенд "jit" сервиса), которая загружается без кода архитектуры
+def save_model(model, path):
+    torch.save(model, path)
+    input_size = getattr(model, "input_size", 224)
+    scripted = copy.deepcopy(model).cpu().eval()
+    with torch.no_grad():
+        scripted = torch.jit.trace(scripted, torch.randn(1, 3, input_size, input_size))
+    torch.jit.save(scripted, os.path.splitext(path)[0] + ".jit.pt", _extra_files={"input_size": str(input_size)})
+
+# Преобразование для сети с входом input_size: Resize пропорционален 256/224, как у transform
+def make_transform(input_size):
+    return transforms.Compose([
+        transforms.Resize(round(input_size * 256 / 224)),
+        transforms.CenterCrop(input_size),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+# Две вырезки одного изображения: для учителя и для ученика со своими размерами входа
+class PairTransform:
+    def __init__(self, teacher_transform, student_transform):
+        self.teacher_transform = teacher_transform
+        self.student_transform = student_transform
+
+    def __call__(self, image):
+        return self.teacher_transform(image), self.student_transform(image)
+
+# Облегченная сеть-ученик: MobileNetV3-Small с новым последним слоем. Размер входа сохраняется
+# в модели (input_size), по нему сервис вырезает знаки для классификатора
+def build_student(num_classes=7, input_size=128, pretrained=True):
+    student = models.mobilenet_v3_small(pretrained=pretrained)
+    student.classifier[-1] = nn.Linear(student.classifier[-1].in_features, num_classes)
+    student.input_size = input_size
+    return student
+
+# функция потерь дистилляции: KL между смягченными распределениями ученика и учителя
+# (умножается на T^2, чтобы градиенты не зависели от температуры) плюс кросс-энтропия по меткам
+def distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    soft_loss = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=1),
+        F.softmax(teacher_logits / temperature, dim=1),
+        reduction="batchmean"
+    ) * temperature ** 2
+    hard_loss = F.cross_entropy(student_logits, labels)
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+# функция, отвечающая за дистилляцию ученика на одной эпохе
+def distill(student, teacher, dataloader, optimizer, temperature, alpha, device):
+    epoch_acc = 0
+    epoch_loss = 0
+    student.train()
+    # учитель только выдает логиты
+    teacher.eval()
+    for (teacher_images, student_images), labels in dataloader:
+        teacher_images = teacher_images.to(device)
+        student_images = student_images.to(device)
+        labels = labels.to(device)
+        with torch.no_grad():
+            teacher_logits = teacher(teacher_images)
+        optimizer.zero_grad()
+        predicts = student(student_images)
+        loss = distillation_loss(predicts, teacher_logits, labels, temperature, alpha)
+        acc = calculate_accuracy(predicts, labels)
+        loss.backward()
+        optimizer.step()
+        epoch_loss += loss.item()
+        epoch_acc  += acc.item()
+    return epoch_loss / len(dataloader),  epoch_acc / len(dataloader)
+
+# задержка сети на одну вырезку на CPU, мс
+def measure_latency(model, input_size, batch_size=1, iterations=50):
+    model = copy.deepcopy(model).cpu().eval()
+    batch = torch.randn(batch_size, 3, input_size, input_size)
+    with torch.no_grad():
+        for _ in range(5):
+            model(batch)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            model(batch)
+    return (time.perf_counter() - started) / iterations / batch_size * 1000
+
+# Дистилляция: ученик обучается по логитам текущей модели и сохраняется целиком, как и она,
+# поэтому подходит вместо resnet101_best_loss.pth в path_to_classifier. В конце проверяется бюджет задержки
+def main_distill(args):
+    teacher = torch.load(args.teacher, map_location=device)
+    teacher.eval()
+    teacher_size = getattr(teacher, "input_size", 224)
+
+    student_transform = make_transform(args.input_size)
+    train_data = dataset.ImageFolder(train_path, PairTransform(make_transform(teacher_size), student_transform))
+    test_data = dataset.ImageFolder(test_path, student_transform)
+    train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True)
+    test_loader = DataLoader(test_data, batch_size=args.batch_size)
+
+    student = build_student(len(train_data.classes), args.input_size)
+    student.to(device)
+
+    optimizer = optim.Adam(student.parameters(), lr=args.lr)
+    loss_function = nn.CrossEntropyLoss()
+    best_loss = 1000000
+    for epoch in range(args.epochs):
+
+        train_loss, train_acc = distill(student, teacher, train_loader, optimizer, args.temperature, args.alpha, device)
+
+        test_loss, test_acc   = evaluate(student, test_loader, loss_function, device)
+
+        print(f'Epoch: {epoch+1}')
+        print(f'\tDistill Loss: {train_loss} | Train Acc: {train_acc*100}%')
+        print(f'\tTest Loss: {test_loss} |  Test Acc: {test_acc*100}%')
+
+        if test_loss < best_loss:
+            best_loss = test_loss
+            save_model(student, args.output)
+
+    # сравнение с учителем на тестовой выборке
+    teacher_loader = DataLoader(dataset.ImageFolder(test_path, make_transform(teacher_size)), batch_size=args.batch_size)
+    _, teacher_acc = evaluate(teacher, teacher_loader, loss_function, device)
+    student = torch.load(args.output, map_location=device)
+    _, student_acc = evaluate(student, test_loader, loss_function, device)
+
+    # проверка бюджета задержки на CPU
+    teacher_latency = measure_latency(teacher, teacher_size)
+    student_latency = measure_latency(student, args.input_size)
+    speedup = teacher_latency / student_latency
+    print(f'Teacher: Test Acc {teacher_acc*100:.2f}% | {teacher_latency:.2f} ms/crop ({teacher_size}x{teacher_size})')
+    print(f'Student: Test Acc {student_acc*100:.2f}% | {student_latency:.2f} ms/crop ({args.input_size}x{args.input_size})')
+    print(f'Speedup: {speedup:.1f}x')
+
+    if speedup < args.min_speedup:
+        print(f'Latency budget failed: speedup {speedup:.1f}x < {args.min_speedup}x')
+        sys.exit(1)
+    if args.latency_budget_ms is not None and student_latency > args.latency_budget_ms:
+        print(f'Latency budget failed: {student_latency:.2f} ms/crop > {args.latency_budget_ms} ms/crop')
+        sys.exit(1)
+
+# Ключ кэша признаков: файлы выборки (путь, размер, время изменения), классы, преобразование и сеть.
+# Любое изменение выборки или предобработки дает новый ключ и пересчет признаков
+def feature_cache_key(data, backbone_name):
+    key = hashlib.sha1()
+    key.update(f"{backbone_name};{data.transform!r};{sorted(data.class_to_idx.items())!r};".encode())
+    for path, label in data.samples:
+        stat = os.stat(path)
+        key.update(f"{os.path.relpath(path, data.root)}:{label}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return key.hexdigest()[:16]
+
+# Признаки замороженной части сети для всей выборки в memmap-массиве на диске (N, размер признака).
+# Файлы пишутся под временными именами и переименовываются после расчета всей выборки
+def cached_features(backbone, data, cache_dir, name, backbone_name, batch_size, workers):
+    key = feature_cache_key(data, backbone_name)
+    features_path = os.path.join(cache_dir, f"{name}_{key}.features.npy")
+    labels_path = os.path.join(cache_dir, f"{name}_{key}.labels.npy")
+
+    if len(data) == 0:
+        raise ValueError(f'No images in {name} dataset, nothing to extract features from')
+
+    if not (os.path.exists(features_path) and os.path.exists(labels_path)):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Признаки устаревших версий выборки удаляются
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(f"{name}_") and not file_name.startswith(f"{name}_{key}."):
+                os.remove(os.path.join(cache_dir, file_name))
+
+        print(f'Extracting {name} features: {len(data)} images -> {features_path}')
+        loader = DataLoader(data, batch_size=batch_size, num_workers=workers)
+        backbone.eval()
+        features = None
+        labels = np.empty(len(data), dtype=np.int64)
+        offset = 0
+        with torch.no_grad():
+            for images, batch_labels in loader:
+                batch_features = backbone(images.to(device)).flatten(1).cpu().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        features_path + ".tmp", mode="w+", dtype=np.float32,
+                        shape=(len(data), batch_features.shape[1])
+                    )
+                features[offset:offset + len(batch_features)] = batch_features
+                labels[offset:offset + len(batch_labels)] = batch_labels.numpy()
+                offset += len(batch_features)
+        features.flush()
+        del features
+        np.save(labels_path + ".tmp.npy", labels)
+        os.replace(features_path + ".tmp", features_path)
+        os.replace(labels_path + ".tmp.npy", labels_path)
+
+    return np.load(features_path, mmap_mode="r"), np.load(labels_path)
+
+# Выборка признаков из memmap: в память читаются только строки текущего батча
+class FeatureDataset(Dataset):
+    def __init__(self, features, labels):
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.features[idx])), int(self.labels[idx])
+
+# Обучение только головы fc на признаках из кэша: замороженная часть сети прогоняется по выборке
+# один раз. Признаки считаются в режиме eval, как при инференсе. Сохраняется вся модель целиком
+def main_cached(args):
+    pretrained_resnet101 = build_model()
+    pretrained_resnet101.to(device)
+    head = pretrained_resnet101.fc
+    pretrained_resnet101.fc = nn.Identity()
+    backbone_name = "resnet50-imagenet"
+
+    train_data = dataset.ImageFolder(train_path, transform)
+    test_data = dataset.ImageFolder(test_path, transform)
+    train_features, train_labels = cached_features(
+        pretrained_resnet101, train_data, args.feature_cache, "train", backbone_name, args.batch_size, args.workers
+    )
+    test_features, test_labels = cached_features(
+        pretrained_resnet101, test_data, args.feature_cache, "test", backbone_name, args.batch_size, args.workers
+    )
+    pretrained_resnet101.fc = head
+
+    train_loader_1 = DataLoader(FeatureDataset(train_features, train_labels), batch_size=args.batch_size, shuffle=True)
+    test_loader_1  = DataLoader(FeatureDataset(test_features, test_labels), batch_size=args.batch_size)
+
+    epochs = args.epochs
+    optimizer = optim.Adam(head.parameters(), lr=args.lr)
+    loss_function = nn.CrossEntropyLoss()
+    best_loss = 1000000
+    for epoch in range(epochs):
+
+        train_loss, train_acc = train(head, train_loader_1, optimizer, loss_function, device)
+
+        test_loss, test_acc   = evaluate(head, test_loader_1, loss_function, device)
+
+        print(f'Epoch: {epoch+1}')
+        print(f'\tTrain Loss: {train_loss} | Train Acc: {train_acc*100}%')
+        print(f'\tTest Loss: {test_loss} |  Test Acc: {test_acc*100}%')
+
+        if test_loss < best_loss:
+            best_loss = test_loss
+            save_model(pretrained_resnet101, args.output)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Обучение классификатора дорожных знаков")
+    parser.add_argument("--cached-features", action="store_true",
+                        help="Обучать только голову на признаках, сохраненных в --feature-cache")
+    parser.add_argument("--feature-cache", default="feature_cache", help="Каталог кэша признаков")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 0,
+                        help="Процессы загрузки изображений при расчете признаков")
+    parser.add_argument("--distill", action="store_true", help="Дистилляция облегченного ученика по логитам --teacher")
+    parser.add_argument("--teacher", default="resnet101_best_loss.pth", help="Текущая модель (учитель)")
+    parser.add_argument("--output", default=None,
+                        help="Файл модели (по умолчанию resnet101_best_loss.pth, при --distill mobilenet_distilled.pth)")
+    parser.add_argument("--input-size", type=int, default=128, help="Размер входа ученика")
+    parser.add_argument("--epochs", type=int, default=25)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--temperature", type=float, default=4.0, help="Температура смягчения логитов")
+    parser.add_argument("--alpha", type=float, default=0.7, help="Вес потерь дистилляции относительно меток")
+    parser.add_argument("--min-speedup", type=float, default=3.0, help="Минимальное ускорение на вырезку")
+    parser.add_argument("--latency-budget-ms", type=float, default=None, help="Максимальная задержка ученика, мс")
+    return parser.parse_args()
+
+def main():
+    train_data = dataset.ImageFolder(train_path, transform)
+    test_data = dataset.ImageFolder(test_path, transform)
+
+    train_loader_1 = DataLoader(train_data, batch_size=16, shuffle=True)
+    test_loader_1  = DataLoader(train_data, batch_size=16, shuffle=True)
+
+    pretrained_resnet101 = build_model()
+    pretrained_resnet101.to(device)
+
+    # попробуем обучить!
+
+    epochs = 25
+    optimizer = optim.Adam(pretrained_resnet101.parameters(), lr=0.001)
+    loss_function = nn.CrossEntropyLoss()
+    best_loss = 1000000
+    best_acc = 0
+    for epoch in range(epochs):
+
+        train_loss, train_acc = train(pretrained_resnet101, train_loader_1, optimizer, loss_function, device)
+
+        test_loss, test_acc   = evaluate(pretrained_resnet101, test_loader_1, loss_function, device)
+
+        print(f'Epoch: {epoch+1}')
+        print(f'\tTrain Loss: {train_loss} | Train Acc: {train_acc*100}%')
+        print(f'\tTest Loss: {test_loss} |  Test Acc: {test_acc*100}%')
 
-    test_loss, test_acc   = evaluate(pretrained_resnet101, test_loader_1, loss_function, device)
 
-    print(f'Epoch: {epoch+1}')
-    print(f'\tTrain Loss: {train_loss} | Train Acc: {train_acc*100}%')
-    print(f'\tTest Loss: {test_loss} |  Test Acc: {test_acc*100}%')
+        if test_loss < best_loss:
+            best_loss = test_loss
+            save_model(pretrained_resnet101, "resnet101_best_loss.pth")
 
 
-    if test_loss < best_loss:
-        best_loss = test_loss
-        torch.save(pretrained_resnet101, "resnet101_best_loss.pth")
+if __name__ == '__main__':
+    args = parse_args()
+    args.output = args.output or ("mobilenet_distilled.pth" if args.distill else "resnet101_best_loss.pth")
+    if args.distill:
+        main_distill(args)
+    elif args.cached_features:
+        main_cached(args)
+    else:
+        main()
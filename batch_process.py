@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from detection_client import (InferenceClient, DetectionCache, DetectionStore, ExportPipeline,
+                              draw_detections, write_report, MAX_IN_FLIGHT)
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv"}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+
+
+# Пакетная обработка видео и папок с изображениями без графического интерфейса.
+# Использует те же клиент, конвейер экспорта, хранилище детекций и отчеты, что и VideoApp
+def parse_args():
+    parser = argparse.ArgumentParser(description="Пакетная детекция объектов на видео и изображениях")
+    parser.add_argument("inputs", nargs="+", help="Видеофайлы и/или каталоги с видео и изображениями")
+    parser.add_argument("-o", "--output-dir", default="batch_output", help="Каталог для результатов")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="Число параллельных процессов обработки")
+    parser.add_argument("--server", default="http://localhost:8000", help="Адрес сервиса детекции")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT,
+                        help="Число кадров, одновременно отправленных на сервер одним процессом")
+    parser.add_argument("--raw", action="store_true", help="Отправлять кадры без JPEG-сжатия (эндпоинт /raw)")
+    parser.add_argument("--no-video", action="store_true", help="Не сохранять размеченные видео (изображения сохраняются)")
+    return parser.parse_args()
+
+
+# Разбор входных путей на видео и группы изображений (по каталогам)
+def collect_inputs(paths):
+    videos = []
+    image_dirs = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, name)
+                extension = os.path.splitext(name)[1].lower()
+                if extension in VIDEO_EXTENSIONS:
+                    videos.append(file_path)
+                elif extension in IMAGE_EXTENSIONS:
+                    image_dirs.setdefault(path, []).append(file_path)
+        elif os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+            videos.append(path)
+        elif os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+            image_dirs.setdefault(os.path.dirname(path) or ".", []).append(path)
+        else:
+            print(f"Пропущен неподдерживаемый путь: {path}")
+    return videos, image_dirs
+
+
+def make_client(options):
+    server = options["server"].rstrip("/")
+    return InferenceClient(
+        api_url=f"{server}/file",
+        raw_api_url=f"{server}/raw",
+        version_api_url=f"{server}/version",
+        max_in_flight=options["max_in_flight"],
+        raw=options["raw"]
+    )
+
+
+# Каталог результатов называется по имени входного файла или каталога ("." - по имени текущего каталога)
+def output_dir_for(path, options):
+    name = os.path.splitext(os.path.basename(os.path.abspath(path)))[0]
+    output_dir = os.path.join(options["output_dir"], name)
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+
+# Обработка одного видео: размеченное видео, покадровые детекции и отчеты txt/json/csv
+def process_video(video_path, options):
+    started = time.time()
+    output_dir = output_dir_for(video_path, options)
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Не удалось открыть видео: {video_path}")
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    duration = total_frames / fps if fps > 0 else 0
+
+    client = make_client(options)
+    cache = DetectionCache(video_path, client.model_version())
+    store = DetectionStore()
+
+    def annotate(frame_idx, frame, objects):
+        if objects is not None:
+            cache.put(frame_idx, objects)
+            store.add(frame_idx, frame_idx / fps if fps > 0 else 0, objects)
+        return frame if options["no_video"] else draw_detections(frame, objects or [])
+
+    output_video = None if options["no_video"] else os.path.join(output_dir, "annotated.mp4")
+    pipeline = ExportPipeline(
+        video_path, 0, total_frames, output_video, cv2.VideoWriter_fourcc(*'mp4v'), fps, frame_size,
+        client, cache, annotate
+    )
+    pipeline.start()
+    while not pipeline.done():
+        time.sleep(0.5)
+
+    client.close()
+    cache.close()
+    if pipeline.error is not None:
+        raise pipeline.error
+
+    with open(os.path.join(output_dir, "detections.csv"), "w", encoding="utf-8") as f:
+        store.write_detections_csv(f)
+    minute_counts = store.minute_snapshot()
+    for fmt in ("txt", "json", "csv"):
+        with open(os.path.join(output_dir, f"report.{fmt}"), "w", encoding="utf-8") as f:
+            write_report(f, fmt, os.path.basename(video_path), duration, minute_counts)
+
+    return {"input": video_path, "frames": pipeline.frames_written, "seconds": time.time() - started}
+
+
+# Обработка каталога изображений: размеченные изображения и детекции в JSONL (строка на файл)
+def process_images(image_dir, image_paths, options):
+    started = time.time()
+    output_dir = output_dir_for(image_dir, options)
+    client = make_client(options)
+
+    def read_images():
+        for i, path in enumerate(image_paths):
+            image = cv2.imread(path)
+            if image is None:
+                print(f"Не удалось прочитать изображение: {path}")
+                continue
+            yield i, image
+
+    processed = 0
+    with open(os.path.join(output_dir, "detections.jsonl"), "w", encoding="utf-8") as f:
+        for i, image, objects in client.map_frames(read_images()):
+            name = os.path.basename(image_paths[i])
+            f.write(json.dumps({"image": name, "objects": objects}, ensure_ascii=False) + "\n")
+            cv2.imwrite(os.path.join(output_dir, name), draw_detections(image, objects or []))
+            processed += 1
+
+    client.close()
+    return {"input": image_dir, "frames": processed, "seconds": time.time() - started}
+
+
+def main():
+    args = parse_args()
+    options = {
+        "output_dir": args.output_dir,
+        "server": args.server,
+        "max_in_flight": args.max_in_flight,
+        "raw": args.raw,
+        "no_video": args.no_video,
+    }
+    videos, image_dirs = collect_inputs(args.inputs)
+    if not videos and not image_dirs:
+        print("Нет видео или изображений для обработки")
+        return
+
+    started = time.time()
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(process_video, path, options): path for path in videos}
+        futures.update({
+            executor.submit(process_images, image_dir, paths, options): image_dir
+            for image_dir, paths in image_dirs.items()
+        })
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Ошибка: {futures[future]}: {e}")
+                continue
+            results.append(result)
+            fps = result["frames"] / result["seconds"] if result["seconds"] > 0 else 0
+            print(f"Готово: {result['input']} | кадров: {result['frames']} | "
+                  f"{result['seconds']:.1f} с | {fps:.1f} кадр/с")
+
+    elapsed = time.time() - started
+    total_frames = sum(result["frames"] for result in results)
+    print(f"\nОбработано: {len(results)} из {len(results) + failed} | кадров: {total_frames} | "
+          f"время: {elapsed:.1f} с | пропускная способность: {total_frames / elapsed if elapsed > 0 else 0:.1f} кадр/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,309 @@
+import os
+import copy
+import warnings
+import numpy as np
 import torch
+from PIL import Image
 from torchvision import transforms
+from torchvision.ops import roi_align
+from detector import backend_name, exported_path
 
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# Размер входа модели по умолчанию; облегченные модели хранят свой в атрибуте input_size
+DEFAULT_INPUT_SIZE = 224
+# Допустимое максимальное расхождение логитов тензорного и PIL-пути вырезки
+PARITY_TOLERANCE = 0.1
+
+# Resize и CenterCrop для входа input_size: при обучении отношение сторон 256 к 224
+def crop_sizes(input_size: int = DEFAULT_INPUT_SIZE) -> tuple[int, int]:
+    return round(input_size * 256 / 224), input_size
+
+# Преобразование вырезки для классификатора (как при обучении)
+def default_transform(resize_size: int = 256, crop_size: int = 224):
+    return transforms.Compose([
+        transforms.Resize(resize_size),
+        transforms.CenterCrop(crop_size),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)
+    ])
+
+# Бэкенд классификатора на PyTorch. Остальные бэкенды повторяют интерфейс:
+# model_path, input_size и predict на батче нормализованных вырезок (N, 3, input_size, input_size)
 class Classifier:
-    def __init__(self, model_path, class_names):
-        self.model = torch.load(model_path, map_location=torch.device('cuda 0'))
+    backend = "torch"
+
+    def __init__(self, model_path, class_names, device=None):
+        self.device = device or torch.device("cpu")
+        self.model_path = model_path
+        self.model = torch.load(model_path, map_location=self.device)
         self.model.eval()
         self.class_names = class_names
-        self.transform = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-        ])
+        self.input_size = getattr(self.model, "input_size", DEFAULT_INPUT_SIZE)
+        self.transform = default_transform(*crop_sizes(self.input_size))
 
     def classify(self, image):
-        tensor_image = self.transform(image).unsqueeze(0)
-        with torch.no_grad():
-            output = self.model(tensor_image)
+        tensor_image = self.transform(image).unsqueeze(0).to(self.device)
+        output = self.predict(tensor_image)
         _, predicted_idx = torch.max(output, 1)
         class_index = predicted_idx.item()
-        return self.class_names[class_index]
\ No newline at end of file
+        return self.class_names[class_index]
+
+    # Логиты батча вырезок
+    def predict(self, batch: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.model(batch)
+
+
+# Бэкенд ONNX Runtime для модели, экспортированной export_models.py
+class OnnxClassifier(Classifier):
+    backend = "onnx"
+
+    def __init__(self, model_path, class_names, device=None):
+        import onnxruntime as ort
+
+        self.device = torch.device("cpu")
+        self.model_path = exported_path(model_path)
+        self.class_names = class_names
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        # Размер входа зафиксирован в графе при экспорте
+        height = self.session.get_inputs()[0].shape[2]
+        self.input_size = height if isinstance(height, int) else DEFAULT_INPUT_SIZE
+        self.transform = default_transform(*crop_sizes(self.input_size))
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+    def predict(self, batch: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.run(batch.cpu().numpy()))
+
+
+# Бэкенд OpenVINO: тот же ONNX-файл компилируется под CPU при загрузке
+class OpenVinoClassifier(OnnxClassifier):
+    backend = "openvino"
+
+    def __init__(self, model_path, class_names, device=None):
+        import openvino as ov
+
+        self.device = torch.device("cpu")
+        self.model_path = exported_path(model_path)
+        self.class_names = class_names
+        self.model = ov.Core().compile_model(self.model_path, "CPU", {"PERFORMANCE_HINT": "LATENCY"})
+        height = self.model.input(0).partial_shape[2]
+        self.input_size = height.get_length() if height.is_static else DEFAULT_INPUT_SIZE
+        self.transform = default_transform(*crop_sizes(self.input_size))
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.model.create_infer_request().infer([batch])[0]
+
+
+# Бэкенд INT8: квантованная модель TorchScript, собранная quantize_classifier.py
+class QuantizedClassifier(Classifier):
+    backend = "int8"
+
+    def __init__(self, model_path, class_names, device=None):
+        torch.backends.quantized.engine = quantized_engine()
+        self.device = torch.device("cpu")
+        self.model_path = quantized_path(model_path)
+        extra_files = {"input_size": ""}
+        self.model = torch.jit.load(self.model_path, map_location=self.device, _extra_files=extra_files)
+        self.model.eval()
+        self.class_names = class_names
+        self.input_size = int(extra_files["input_size"] or DEFAULT_INPUT_SIZE)
+        self.transform = default_transform(*crop_sizes(self.input_size))
+
+
+# Бэкенд TorchScript: трассированная модель, сохраненная при обучении или export_models.py.
+# Загружается без распаковки объектов Python и без кода архитектуры модели
+class ScriptedClassifier(Classifier):
+    backend = "jit"
+
+    def __init__(self, model_path, class_names, device=None):
+        self.device = device or torch.device("cpu")
+        self.model_path = scripted_path(model_path)
+        extra_files = {"input_size": ""}
+        self.model = torch.jit.load(self.model_path, map_location=self.device, _extra_files=extra_files)
+        self.model.eval()
+        self.class_names = class_names
+        self.input_size = int(extra_files["input_size"] or DEFAULT_INPUT_SIZE)
+        self.transform = default_transform(*crop_sizes(self.input_size))
+
+
+CLASSIFIER_BACKENDS = {
+    backend.backend: backend
+    for backend in (Classifier, OnnxClassifier, OpenVinoClassifier, QuantizedClassifier, ScriptedClassifier)
+}
+
+# Бэкенд задается суффиксом названия модели в конфигурации, как у детектора: "ResNet101-onnx", "ResNet101-jit"
+def load_classifier(model_name: str, model_path: str, class_names, device=None) -> Classifier:
+    return CLASSIFIER_BACKENDS[backend_name(model_name, CLASSIFIER_BACKENDS)](model_path, class_names, device)
+
+# Экспорт классификатора в ONNX с переменным размером батча
+def export_classifier(model, onnx_path: str, opset: int = 17):
+    input_size = getattr(model, "input_size", DEFAULT_INPUT_SIZE)
+    model = model.cpu().eval()
+    torch.onnx.export(
+        model, torch.randn(1, 3, input_size, input_size), onnx_path,
+        input_names=["images"], output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset
+    )
+
+# Путь к модели TorchScript: рядом с весами PyTorch, с расширением .jit.pt
+def scripted_path(model_path: str) -> str:
+    return os.path.splitext(model_path)[0] + ".jit.pt"
+
+# Трассировка классификатора в TorchScript; размер входа сохраняется в архиве, как у квантованной модели
+def save_scripted(model, model_path: str):
+    input_size = getattr(model, "input_size", DEFAULT_INPUT_SIZE)
+    model = copy.deepcopy(model).cpu().eval()
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, torch.randn(1, 3, input_size, input_size))
+    torch.jit.save(scripted, scripted_path(model_path), _extra_files={"input_size": str(input_size)})
+
+# Путь к квантованной модели: рядом с весами PyTorch, с расширением .int8.pt
+def quantized_path(model_path: str) -> str:
+    return os.path.splitext(model_path)[0] + ".int8.pt"
+
+# Движок квантованных операций для CPU: x86 (fbgemm + onednn), иначе fbgemm или qnnpack (ARM)
+def quantized_engine() -> str:
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    return engines[0]
+
+# Квантование классификатора в INT8 (FX graph mode): сверточная часть - статически, с калибровкой
+# диапазонов активаций на calibration_batches; линейные слои головы (fc у ResNet, classifier у MobileNet) -
+# динамически, масштаб активаций вычисляется на каждом батче. Возвращает модель TorchScript для save_quantized
+def quantize_classifier(model, calibration_batches, head: str = None):
+    from torch.ao.quantization import QConfigMapping, get_default_qconfig, default_dynamic_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    input_size = getattr(model, "input_size", DEFAULT_INPUT_SIZE)
+    head = head or ("fc" if hasattr(model, "fc") else "classifier")
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = (
+        QConfigMapping()
+        .set_global(get_default_qconfig(engine))
+        .set_module_name(head, default_dynamic_qconfig)
+    )
+    example = torch.randn(1, 3, input_size, input_size)
+    prepared = prepare_fx(model, qconfig_mapping, (example,))
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized, example).eval())
+
+# Размер входа сохраняется в архиве TorchScript: атрибуты исходной модели при трассировке теряются
+def save_quantized(quantized, model_path: str, input_size: int = DEFAULT_INPUT_SIZE):
+    torch.jit.save(quantized, quantized_path(model_path), _extra_files={"input_size": str(input_size)})
+
+# Сравнение логитов экспортированного классификатора с PyTorch на одном батче:
+# возвращает максимальное расхождение логитов и долю совпавших классов
+def classifier_parity(reference: Classifier, candidate: Classifier, batch: torch.Tensor) -> tuple[float, float]:
+    expected = reference.predict(batch.to(reference.device)).cpu().float()
+    actual = candidate.predict(batch.to(candidate.device)).cpu().float()
+    max_diff = (expected - actual).abs().max().item()
+    agreement = (expected.argmax(1) == actual.argmax(1)).float().mean().item()
+    return max_diff, agreement
+
+# Нормализованный RGB-тензор кадра (1, 3, H, W). Нормализация выполняется один раз на кадр
+# до интерполяции: она поканально линейна и перестановочна с билинейной выборкой
+def frame_to_tensor(image: np.ndarray, device, bgr: bool = False) -> torch.Tensor:
+    with warnings.catch_warnings():
+        # Кадр может быть read-only буфером (np.frombuffer); тензор только читается
+        warnings.simplefilter("ignore", UserWarning)
+        tensor = torch.from_numpy(image).to(device).permute(2, 0, 1)
+    if bgr:
+        tensor = tensor.flip(0)
+    tensor = tensor.float().div_(255)
+    mean = torch.tensor(IMAGENET_MEAN, device=device).view(3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=device).view(3, 1, 1)
+    return tensor.sub_(mean).div_(std).unsqueeze(0)
+
+# Области кадра, которые Resize(resize_size) -> CenterCrop(crop_size) берут из вырезки по рамке.
+# Рамки обрезаются до целых пикселей так же, как срез numpy в PIL-варианте
+def crop_regions(boxes: np.ndarray, resize_size: int = 256, crop_size: int = 224) -> np.ndarray:
+    boxes = np.asarray(boxes)[:, :4].astype(np.int64).astype(np.float64)
+    x1, y1, x2, y2 = boxes.T
+    w = np.maximum(x2 - x1, 1)
+    h = np.maximum(y2 - y1, 1)
+
+    # Resize: меньшая сторона приводится к resize_size, большая округляется вниз
+    short = np.minimum(w, h)
+    resized_w = np.where(w <= h, resize_size, np.floor(resize_size * w / short))
+    resized_h = np.where(h <= w, resize_size, np.floor(resize_size * h / short))
+    scale_x = resized_w / w
+    scale_y = resized_h / h
+
+    # CenterCrop: смещение центральной вырезки в координатах масштабированного изображения
+    left = np.round((resized_w - crop_size) / 2)
+    top = np.round((resized_h - crop_size) / 2)
+
+    return np.stack([
+        x1 + left / scale_x,
+        y1 + top / scale_y,
+        x1 + (left + crop_size) / scale_x,
+        y1 + (top + crop_size) / scale_y,
+    ], axis=1)
+
+# Вырезка и масштабирование всех рамок кадра одной операцией ROI Align
+def crop_batch(frame_tensor: torch.Tensor, boxes: np.ndarray, resize_size: int = 256, crop_size: int = 224) -> torch.Tensor:
+    regions = torch.as_tensor(crop_regions(boxes, resize_size, crop_size), dtype=frame_tensor.dtype, device=frame_tensor.device)
+    return roi_align(frame_tensor, [regions], output_size=crop_size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+# Сравнение тензорного пути вырезки с PIL-преобразованием transform на одном кадре:
+# возвращает максимальное расхождение логитов и долю совпавших классов
+def crop_pipeline_parity(model, image: np.ndarray, boxes: np.ndarray, transform, device) -> tuple[float, float]:
+    pil_batch = torch.stack([
+        transform(Image.fromarray(image[int(box[1]):int(box[3]), int(box[0]):int(box[2])]))
+        for box in boxes
+    ]).to(device)
+    input_size = getattr(model, "input_size", DEFAULT_INPUT_SIZE)
+    tensor_batch = crop_batch(frame_to_tensor(image, device), boxes, *crop_sizes(input_size))
+
+    with torch.no_grad():
+        pil_outputs = model(pil_batch)
+        tensor_outputs = model(tensor_batch)
+
+    max_diff = (pil_outputs - tensor_outputs).abs().max().item()
+    agreement = (pil_outputs.argmax(1) == tensor_outputs.argmax(1)).float().mean().item()
+    return max_diff, agreement
+
+# Проверка совпадения тензорного и PIL-пути вырезки на изображении:
+# python classifier.py image.jpg [детектор знаков] [классификатор] [допуск]
+# Код возврата 1, если максимальное расхождение логитов больше допуска
+if __name__ == "__main__":
+    import sys
+    from ultralytics import YOLO
+
+    image_path = sys.argv[1]
+    detector_path = sys.argv[2] if len(sys.argv) > 2 else "best.pt"
+    classifier_path = sys.argv[3] if len(sys.argv) > 3 else "resnet101_best_loss.pth"
+    tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else PARITY_TOLERANCE
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = torch.load(classifier_path, map_location=device)
+    model.eval()
+    transform = default_transform(*crop_sizes(getattr(model, "input_size", DEFAULT_INPUT_SIZE)))
+
+    image = np.array(Image.open(image_path).convert("RGB"))
+    boxes = YOLO(detector_path).predict(image, conf=0.5, verbose=False)[0].boxes.xyxy.cpu().numpy()
+    if len(boxes) == 0:
+        print("На изображении не найдено знаков")
+        sys.exit(0)
+
+    max_diff, agreement = crop_pipeline_parity(model, image, boxes, transform, device)
+    print(f"Знаков: {len(boxes)} | Макс. расхождение логитов: {max_diff:.4f} | Совпадение классов: {agreement * 100:.1f}%")
+    if max_diff > tolerance:
+        print(f"Расхождение логитов {max_diff:.4f} больше допуска {tolerance}")
+        sys.exit(1)
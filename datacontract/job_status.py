@@ -0,0 +1,30 @@
+import pydantic
+from typing import Optional
+
+
+# состояние задачи обработки видео
+class JobStatus(pydantic.BaseModel):
+    job_id: str
+    """Путь к обрабатываемому видео"""
+    video_path: str
+    """queued | running | completed | failed"""
+    status: str = pydantic.Field(default="queued")
+    """Число кадров видео"""
+    total_frames: int = pydantic.Field(default=0)
+    """Число обработанных кадров"""
+    completed_frames: int = pydantic.Field(default=0)
+    """Частота кадров видео"""
+    fps: float = pydantic.Field(default=0.0)
+    """Скорость обработки, кадров в секунду"""
+    processing_fps: float = pydantic.Field(default=0.0)
+    """Текст ошибки для задач в статусе failed"""
+    error: Optional[str] = None
+    """Полный инференс только на ключевых кадрах, между ними - трекинг"""
+    tracking: bool = pydantic.Field(default=False)
+    """Повторное использование результата для статичных кадров и их неизменившихся областей"""
+    motion_gate: bool = pydantic.Field(default=False)
+
+    @pydantic.computed_field
+    @property
+    def progress(self) -> float:
+        return self.completed_frames / self.total_frames if self.total_frames > 0 else 0.0
@@ -1,15 +1,73 @@
 import pydantic
+from typing import Literal, Optional
 
 
 class ServiceConfig(pydantic.BaseModel):
+    """Название классификатора; суффикс -jit, -onnx, -openvino или -int8 выбирает бэкенд (по умолчанию PyTorch).
+    Файлы для -jit, -onnx и -openvino создает export_models.py, для -int8 - quantize_classifier.py"""
     name_of_classifier: str
     path_to_classifier: str
+    """Название детектора; суффикс -onnx или -openvino выбирает бэкенд обоих детекторов"""
     name_of_detector: str
     path_to_detector: str
+    """Веса детектора машин (COCO)"""
+    path_to_car_detector: str = "yolov8s.pt"
 
-    """Целевая ширина изображения"""
+    """Рабочая ширина: кадры крупнее target_width x target_height уменьшаются до этого размера перед детекцией"""
     target_width: int
-    """Целевая высота изображения"""
+    """Рабочая высота (см. target_width)"""
     target_height: int
 
+    """Число процессов сервиса; при значении больше 1 модели загружаются один раз и процессы создаются через fork"""
+    workers: int = 1
+    """Число потоков PyTorch на процесс; по умолчанию ядра процессора делятся поровну между процессами"""
+    threads_per_worker: Optional[int] = None
+
+    """Максимальное число изображений в одном батче инференса"""
+    max_batch_size: int = 8
+    """Число прогревочных батчей каждого размера (1 и max_batch_size) перед готовностью сервиса"""
+    warmup_batches: int = 2
+    """Максимальное время ожидания набора батча, мс"""
+    max_batch_wait_ms: float = 10.0
+    """Число потоков пула, выполняющих инференс батчей"""
+    inference_workers: int = 1
+    """Максимальное число изображений, ожидающих инференса"""
+    inference_queue_size: int = 64
+    """Общий размер входа детекторов; по умолчанию размер обучения детектора знаков"""
+    detection_imgsz: Optional[int] = None
+    """Способ вырезки знаков для классификатора: "tensor" (ROI Align по кадру) или "pil" (по одной вырезке)"""
+    crop_pipeline: Literal["tensor", "pil"] = "tensor"
+    """Путь к журналу результатов (JSONL); если не задан, результаты не сохраняются"""
+    journal_path: Optional[str] = None
+    """Максимальный размер файла журнала в байтах до ротации"""
+    journal_max_bytes: int = 100 * 1024 * 1024
+    """Число хранимых файлов журнала после ротации"""
+    journal_backup_count: int = 5
+    """Период сброса накопленных записей журнала на диск, мс"""
+    journal_flush_interval_ms: float = 1000.0
+    """Максимальное число записей, ожидающих записи в журнал"""
+    journal_queue_size: int = 10000
+    """Каталог задач обработки видео (состояние, контрольные точки, результаты)"""
+    jobs_dir: str = "jobs"
+    """Число кадров видео в одном батче инференса"""
+    job_batch_size: int = 8
+    """Период сохранения контрольной точки задачи, кадров"""
+    job_checkpoint_every: int = 250
+    """Максимальное число кадров одного WebSocket-соединения, находящихся в обработке"""
+    ws_max_in_flight: int = 4
+    """Режим трекинга: период ключевых кадров, на которых выполняется полный инференс"""
+    tracking_keyframe_interval: int = 10
+    """Режим трекинга: минимальная уверенность переноса рамок, ниже которой кадр становится ключевым"""
+    tracking_min_confidence: float = 0.5
+    """Режим трекинга: максимальное расстояние (1 - IoU) при сопоставлении рамки с треком"""
+    tracking_distance_threshold: float = 0.7
+    """Пропуск статичных кадров: порог разности яркости пикселя уменьшенного кадра"""
+    motion_gate_threshold: float = 20.0
+    """Пропуск статичных кадров: доля изменившихся пикселей, при которой ячейка сетки считается изменившейся"""
+    motion_gate_min_changed: float = 0.02
+    """Пропуск статичных кадров: размер сетки ячеек (grid x grid)"""
+    motion_gate_grid: int = 8
+    """Пропуск статичных кадров: доля площади кадра, начиная с которой обрабатывается весь кадр"""
+    motion_gate_max_region: float = 0.5
+
 
@@ -11,11 +11,11 @@ class DetectedObject(pydantic.BaseModel):
 
 # класс(-ы), описывающий выход сервиса
 class ServiceOutput(pydantic.BaseModel):
-    """Ширина преобразованного изображения"""
+    """Ширина исходного изображения, в координатах которого заданы рамки"""
     width: int = pydantic.Field(default=640)
-    """Высота преобразованного изображения"""
+    """Высота исходного изображения, в координатах которого заданы рамки"""
     height: int = pydantic.Field(default=480)
-    """Число каналов преобразованного изображения"""
+    """Число каналов исходного изображения"""
     channels: int = pydantic.Field(default=3)
 
     objects: List[DetectedObject]
\ No newline at end of file
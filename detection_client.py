@@ -0,0 +1,439 @@
+import threading
+import cv2
+import numpy as np
+import requests
+import time
+from datetime import timedelta
+import os
+import json
+import queue
+import hashlib
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Клиент сервиса детекции, кэш и хранилище детекций, конвейер экспорта видео и отчеты.
+# Модуль не зависит от tkinter: его используют и VideoApp (interfes.py), и batch_process.py
+API_URL = "http://localhost:8000/file"
+RAW_API_URL = "http://localhost:8000/raw"
+VERSION_API_URL = "http://localhost:8000/version"
+# Число кадров, одновременно отправленных на сервер при экспорте видео
+MAX_IN_FLIGHT = 4
+# Отправка кадров без JPEG-сжатия (эндпоинт /raw), имеет смысл для локального сервера
+USE_RAW_FRAMES = False
+# Размер очередей между стадиями конвейера экспорта видео, кадров
+EXPORT_QUEUE_SIZE = 16
+
+
+# Отпечаток видеофайла: размер и три фрагмента по 1 МБ (начало, середина, конец).
+# Чтение всего файла для многогигабайтных видео заняло бы заметное время
+def video_fingerprint(path, chunk_size=1024 * 1024):
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in (0, max(0, size // 2 - chunk_size // 2), max(0, size - chunk_size)):
+            f.seek(offset)
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+# Кэш результатов детекции по номеру кадра, сохраняемый в файл рядом с видео
+# (<видео>.detections.jsonl). Первая строка файла - ключ (отпечаток видео и версия моделей),
+# далее по строке на кадр. Если ключ не совпадает, файл начинается заново.
+# Без версии моделей (сервер недоступен) кэш хранится только в памяти
+class DetectionCache:
+    def __init__(self, video_path, model_version, flush_every=50):
+        self.path = video_path + ".detections.jsonl"
+        self.key = {"video": video_fingerprint(video_path), "model_version": model_version}
+        self.persistent = model_version is not None
+        self.flush_every = flush_every
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.unflushed = 0
+        if self.persistent:
+            self.load()
+
+    def load(self):
+        header = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                header = json.loads(f.readline() or "null")
+                if header == self.key:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Последняя строка могла остаться недописанной
+                            break
+                        self.frames[record['frame_idx']] = record['objects']
+        except (OSError, json.JSONDecodeError):
+            header = None
+
+        try:
+            if header == self.key:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            else:
+                self.file = open(self.path, 'w', encoding='utf-8')
+                self.file.write(json.dumps(self.key) + "\n")
+        except OSError as e:
+            print("Не удалось открыть кэш детекций:", e)
+            self.persistent = False
+
+    def get(self, frame_idx):
+        with self.lock:
+            return self.frames.get(frame_idx)
+
+    def put(self, frame_idx, objects):
+        with self.lock:
+            if frame_idx in self.frames:
+                return
+            self.frames[frame_idx] = objects
+            if self.persistent:
+                self.file.write(json.dumps({'frame_idx': frame_idx, 'objects': objects}, ensure_ascii=False) + "\n")
+                self.unflushed += 1
+                if self.unflushed >= self.flush_every:
+                    self.file.flush()
+                    self.unflushed = 0
+
+    def items(self):
+        with self.lock:
+            return sorted(self.frames.items())
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.persistent = False
+
+
+# Хранилище детекций в виде столбцов numpy (кадр, время, класс, рамка) с дедупликацией
+# по номеру кадра. Счетчики объектов по минутам и классам обновляются при добавлении,
+# поэтому отчет строится за O(минуты x классы) без повторного прохода по всем детекциям
+class DetectionStore:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.size = 0
+        self.frame_idx = np.empty(self.capacity, dtype=np.int64)
+        self.frame_time = np.empty(self.capacity, dtype=np.float64)
+        self.class_id = np.empty(self.capacity, dtype=np.int32)
+        self.boxes = np.empty((self.capacity, 4), dtype=np.int32)
+        self.class_names = []
+        self.class_ids = {}
+        self.frames = set()
+        self.minute_counts = defaultdict(lambda: defaultdict(int))
+
+    def grow(self, required):
+        capacity = len(self.frame_idx)
+        while capacity < required:
+            capacity *= 2
+        self.frame_idx = np.resize(self.frame_idx, capacity)
+        self.frame_time = np.resize(self.frame_time, capacity)
+        self.class_id = np.resize(self.class_id, capacity)
+        self.boxes = np.resize(self.boxes, (capacity, 4))
+
+    def add(self, frame_idx, frame_time, objects):
+        # Кадры добавляют и поток интерфейса, и стадия отрисовки конвейера экспорта
+        with self.lock:
+            self.add_unlocked(frame_idx, frame_time, objects)
+
+    def add_unlocked(self, frame_idx, frame_time, objects):
+        if frame_idx in self.frames:
+            return
+        self.frames.add(frame_idx)
+
+        count = len(objects)
+        if self.size + count > len(self.frame_idx):
+            self.grow(self.size + count)
+
+        minute = int(frame_time // 60)
+        end = self.size + count
+        self.frame_idx[self.size:end] = frame_idx
+        self.frame_time[self.size:end] = frame_time
+        for row, obj in enumerate(objects, start=self.size):
+            class_name = obj['class_name']
+            if class_name not in self.class_ids:
+                self.class_ids[class_name] = len(self.class_names)
+                self.class_names.append(class_name)
+            self.class_id[row] = self.class_ids[class_name]
+            self.boxes[row] = (obj['xtl'], obj['ytl'], obj['xbr'], obj['ybr'])
+            self.minute_counts[minute][class_name] += 1
+        self.size = end
+
+    def columns(self):
+        return (self.frame_idx[:self.size], self.frame_time[:self.size],
+                self.class_id[:self.size], self.boxes[:self.size])
+
+    # Копия счетчиков по минутам: отчет строится, пока конвейер экспорта добавляет кадры
+    def minute_snapshot(self):
+        with self.lock:
+            return {minute: dict(counts) for minute, counts in self.minute_counts.items()}
+
+    # Покадровые детекции в CSV, строка на объект
+    def write_detections_csv(self, f):
+        f.write("frame_idx,frame_time,class_name,xtl,ytl,xbr,ybr\n")
+        frame_idx, frame_time, class_id, boxes = self.columns()
+        for i in range(self.size):
+            f.write(f"{frame_idx[i]},{frame_time[i]:.3f},{self.class_names[class_id[i]]},"
+                    f"{boxes[i, 0]},{boxes[i, 1]},{boxes[i, 2]},{boxes[i, 3]}\n")
+
+
+# Отрисовка рамок и подписей объектов на кадре (только классы из class_filters, если задан)
+def draw_detections(frame, objects, class_filters=None):
+    # Размер кадра
+    h, w, _ = frame.shape
+
+    for obj in objects:
+        label = obj['class_name']
+
+        if class_filters is not None and label not in class_filters:
+            continue
+
+        # Координаты — обрезаем по границам кадра
+        xtl = max(0, min(int(obj['xtl']), w - 1))
+        ytl = max(0, min(int(obj['ytl']), h - 1))
+        xbr = max(0, min(int(obj['xbr']), w - 1))
+        ybr = max(0, min(int(obj['ybr']), h - 1))
+
+        # Отрисовка прямоугольника и подписи
+        cv2.rectangle(frame, (xtl, ytl), (xbr, ybr), (0, 0, 255), 2)
+        cv2.putText(frame, label, (xtl, max(ytl - 10, 0)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+
+    return frame
+
+
+# Запись отчета по минутам в файл в формате txt, json или csv
+def write_report(f, fmt, video_name, duration, minute_counts):
+    minutes = sorted(minute_counts.keys())
+    if fmt == "txt":
+        f.write("Отчет по видео:\n\n")
+        f.write(f"Видео: {video_name}\n")
+        f.write(f"Длительность: {str(timedelta(seconds=duration))}\n\n")
+        f.write("Детекция по минутам:\n")
+        for minute in minutes:
+            f.write(f"\nМинута {minute}:\n")
+            for class_name, count in minute_counts[minute].items():
+                f.write(f"  {class_name}: {count}\n")
+    elif fmt == "json":
+        report_json = {
+            "video_file": video_name,
+            "duration": str(timedelta(seconds=duration)),
+            "detection_data": {f"minute_{minute}": dict(minute_counts[minute])
+                               for minute in minutes}
+        }
+        json.dump(report_json, f, indent=4, ensure_ascii=False)
+    elif fmt == "csv":
+        f.write("Минута,Класс,Количество")
+        for minute in minutes:
+            for class_name, count in minute_counts[minute].items():
+                f.write(f"\n{minute},{class_name},{count}")
+
+
+# Конвейер экспорта видео: декодирование -> инференс -> отрисовка -> кодирование.
+# Каждая стадия работает в своем потоке, стадии связаны очередями ограниченного размера.
+# Декодирование идет собственным VideoCapture последовательно, без перемоток.
+# Без output_path стадия кодирования только считает кадры (нужны лишь детекции)
+class ExportPipeline:
+    STOP = object()
+
+    def __init__(self, video_path, start_frame, end_frame, output_path, fourcc, fps, frame_size,
+                 client, cache, annotate, queue_size=EXPORT_QUEUE_SIZE):
+        self.video_path = video_path
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.output_path = output_path
+        self.fourcc = fourcc
+        self.fps = fps
+        self.frame_size = frame_size
+        self.client = client
+        self.cache = cache
+        self.annotate = annotate
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.inferred = queue.Queue(maxsize=queue_size)
+        self.annotated = queue.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+        self.total_frames = max(0, end_frame - start_frame)
+        self.frames_written = 0
+        self.started = None
+        self.error = None
+        self.threads = []
+
+    def start(self):
+        self.started = time.time()
+        for stage in (self.decode_stage, self.infer_stage, self.annotate_stage, self.encode_stage):
+            thread = threading.Thread(target=self.run_stage, args=(stage,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def done(self):
+        return all(not thread.is_alive() for thread in self.threads)
+
+    def progress(self):
+        return self.frames_written / self.total_frames * 100 if self.total_frames > 0 else 100.0
+
+    def throughput(self):
+        elapsed = time.time() - self.started if self.started else 0
+        return self.frames_written / elapsed if elapsed > 0 else 0.0
+
+    def run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            self.error = e
+            self.cancel()
+
+    def put(self, q, item):
+        while not self.cancelled.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        while not self.cancelled.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return self.STOP
+
+    def decode_stage(self):
+        cap = cv2.VideoCapture(self.video_path)
+        try:
+            if self.start_frame > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            for i in range(self.start_frame, self.end_frame):
+                ret, frame = cap.read()
+                if not ret or not self.put(self.decoded, (i, frame)):
+                    break
+        finally:
+            cap.release()
+            self.put(self.decoded, self.STOP)
+
+    def infer_stage(self):
+        frames = iter(lambda: self.get(self.decoded), self.STOP)
+        try:
+            for item in self.client.map_frames(frames, self.cache):
+                if not self.put(self.inferred, item):
+                    break
+        finally:
+            self.put(self.inferred, self.STOP)
+
+    def annotate_stage(self):
+        try:
+            while (item := self.get(self.inferred)) is not self.STOP:
+                frame_idx, frame, objects = item
+                if not self.put(self.annotated, self.annotate(frame_idx, frame, objects)):
+                    break
+        finally:
+            self.put(self.annotated, self.STOP)
+
+    def encode_stage(self):
+        out = None
+        if self.output_path is not None:
+            out = cv2.VideoWriter(self.output_path, self.fourcc, self.fps, self.frame_size)
+        try:
+            while (frame := self.get(self.annotated)) is not self.STOP:
+                if out is not None:
+                    out.write(frame)
+                self.frames_written += 1
+        finally:
+            if out is not None:
+                out.release()
+
+
+# Клиент сервиса детекции с keep-alive соединениями и конвейерной отправкой кадров
+class InferenceClient:
+    def __init__(self, api_url=API_URL, raw_api_url=RAW_API_URL, max_in_flight=MAX_IN_FLIGHT, raw=USE_RAW_FRAMES,
+                 version_api_url=VERSION_API_URL):
+        self.api_url = api_url
+        self.raw_api_url = raw_api_url
+        self.version_api_url = version_api_url
+        self.max_in_flight = max(1, max_in_flight)
+        self.raw = raw
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="inference-client")
+
+    # У каждого потока своя сессия: соединение с сервером переиспользуется между кадрами
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.local.session = session
+        return session
+
+    def detect(self, frame):
+        if self.raw:
+            response = self.session().post(
+                self.raw_api_url,
+                data=np.ascontiguousarray(frame).tobytes(),
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "X-Frame-Shape": ",".join(str(dim) for dim in frame.shape),
+                    "X-Frame-Dtype": "uint8",
+                    "X-Frame-Channels": "BGR"
+                }
+            )
+        else:
+            _, img_encoded = cv2.imencode('.jpg', frame)
+            files = {'image': ('frame.jpg', img_encoded.tobytes(), 'image/jpeg')}
+            response = self.session().post(self.api_url, files=files)
+        response.raise_for_status()
+        return response.json().get("objects", [])
+
+    def submit(self, frame):
+        return self.executor.submit(self.detect, frame)
+
+    def model_version(self):
+        try:
+            response = self.session().get(self.version_api_url, timeout=5)
+            response.raise_for_status()
+            return response.json().get("model_version")
+        except Exception as e:
+            print("Не удалось получить версию моделей:", e)
+            return None
+
+    @staticmethod
+    def result(future):
+        try:
+            return future.result()
+        except Exception as e:
+            print("Ошибка при запросе к серверу:", e)
+            return None
+
+    # Конвейерная обработка: пока ждем ответы по ранним кадрам, следующие уже читаются
+    # и отправляются (не более max_in_flight одновременно). Результаты отдаются в порядке кадров.
+    # Кадры, для которых cache возвращает готовый результат, на сервер не отправляются
+    def map_frames(self, frames, cache=None):
+        pending = deque()
+        for frame_idx, frame in frames:
+            objects = cache.get(frame_idx) if cache is not None else None
+            if objects is not None:
+                future = Future()
+                future.set_result(objects)
+            else:
+                future = self.submit(frame)
+            pending.append((frame_idx, frame, future))
+            if len(pending) >= self.max_in_flight:
+                frame_idx, frame, future = pending.popleft()
+                yield frame_idx, frame, self.result(future)
+        while pending:
+            frame_idx, frame, future = pending.popleft()
+            yield frame_idx, frame, self.result(future)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
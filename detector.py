@@ -1,9 +1,174 @@
+import os
+import json
+import cv2
+import numpy as np
+import torch
 from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from ultralytics.utils import ops
+from torchvision.ops import box_iou
 
+# Порог IoU для NMS, как в predict ultralytics по умолчанию
+NMS_IOU = 0.7
+MAX_DET = 300
+
+# Бэкенд детектора на PyTorch (ultralytics). Остальные бэкенды повторяют интерфейс:
+# names, imgsz, stride, model_path и predict на общем letterbox-тензоре кадров
 class Detector:
+    backend = "torch"
+
     def __init__(self, model_path):
+        self.model_path = model_path
         self.model = YOLO(model_path)
+        self.names = self.model.names
+        self.imgsz = model_imgsz(self.model)
+        self.stride = int(max(self.model.model.stride)) if hasattr(self.model.model, "stride") else 32
+
+    # Детекции батча: по тензору (n, 6) на кадр - x1, y1, x2, y2, conf, cls в координатах тензора
+    def predict(self, frames_tensor: torch.Tensor, conf: float, classes: list[int] = None) -> list[torch.Tensor]:
+        results = self.model.predict(frames_tensor, conf=conf, classes=classes, verbose=False)
+        return [result.boxes.data for result in results]
+
+
+# Бэкенд ONNX Runtime для модели, экспортированной export_models.py
+class OnnxDetector(Detector):
+    backend = "onnx"
+
+    def __init__(self, model_path):
+        import onnxruntime as ort
+
+        self.model_path = exported_path(model_path)
+        self.names, self.imgsz, self.stride = read_metadata(self.model_path)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+    def predict(self, frames_tensor: torch.Tensor, conf: float, classes: list[int] = None) -> list[torch.Tensor]:
+        prediction = torch.from_numpy(self.run(frames_tensor.cpu().numpy()))
+        return postprocess(prediction, conf, classes)
+
+
+# Бэкенд OpenVINO: тот же ONNX-файл компилируется под CPU при загрузке
+class OpenVinoDetector(OnnxDetector):
+    backend = "openvino"
+
+    def __init__(self, model_path):
+        import openvino as ov
+
+        self.model_path = exported_path(model_path)
+        self.names, self.imgsz, self.stride = read_metadata(self.model_path)
+        self.model = ov.Core().compile_model(self.model_path, "CPU", {"PERFORMANCE_HINT": "LATENCY"})
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        # Запрос создается на каждый вызов: скомпилированную модель можно вызывать из нескольких потоков
+        return self.model.create_infer_request().infer([batch])[0]
+
+
+DETECTOR_BACKENDS = {backend.backend: backend for backend in (Detector, OnnxDetector, OpenVinoDetector)}
+
+# Бэкенд задается суффиксом названия модели в конфигурации: "YOLOv10" - PyTorch,
+# "YOLOv10-onnx" - ONNX Runtime, "YOLOv10-openvino" - OpenVINO
+def backend_name(model_name: str, backends) -> str:
+    suffix = model_name.rsplit("-", 1)[-1].lower()
+    return suffix if "-" in model_name and suffix in backends else "torch"
+
+def load_detector(model_name: str, model_path: str) -> Detector:
+    return DETECTOR_BACKENDS[backend_name(model_name, DETECTOR_BACKENDS)](model_path)
+
+# Путь к экспортированной модели: рядом с весами PyTorch, с расширением .onnx
+def exported_path(model_path: str) -> str:
+    return os.path.splitext(model_path)[0] + ".onnx"
+
+# Метаданные экспортированного детектора хранятся рядом с моделью в <модель>.onnx.json
+def read_metadata(model_path: str) -> tuple[dict[int, str], int, int]:
+    with open(model_path + ".json", "r") as metadata_file:
+        metadata = json.load(metadata_file)
+    return {int(idx): name for idx, name in metadata["names"].items()}, metadata["imgsz"], metadata["stride"]
+
+def write_metadata(model_path: str, detector: Detector):
+    with open(model_path + ".json", "w") as metadata_file:
+        json.dump({"names": detector.names, "imgsz": detector.imgsz, "stride": detector.stride}, metadata_file, indent=4)
+
+# Постобработка выхода экспортированной модели: NMS для выхода (B, 4 + nc, N) или
+# фильтрация для моделей со встроенным NMS с выходом (B, max_det, 6)
+def postprocess(prediction: torch.Tensor, conf: float, classes: list[int] = None) -> list[torch.Tensor]:
+    if prediction.shape[-1] == 6:
+        detections = []
+        for image_prediction in prediction:
+            keep = image_prediction[:, 4] > conf
+            if classes is not None:
+                keep &= torch.isin(image_prediction[:, 5], torch.tensor(classes, dtype=image_prediction.dtype))
+            detections.append(image_prediction[keep])
+        return detections
+    return ops.non_max_suppression(prediction, conf, NMS_IOU, classes=classes, max_det=MAX_DET)
+
+# Сравнение детекций экспортированной модели с PyTorch на одном тензоре кадров:
+# возвращает максимальное расхождение координат совпавших рамок и долю совпавших рамок
+def detector_parity(reference: Detector, candidate: Detector, frames_tensor: torch.Tensor,
+                    conf: float = 0.5, iou: float = 0.5) -> tuple[float, float]:
+    max_diff = 0.0
+    matched = 0
+    total = 0
+    for expected, actual in zip(reference.predict(frames_tensor, conf), candidate.predict(frames_tensor, conf)):
+        expected, actual = expected.cpu().float(), actual.cpu().float()
+        total += max(len(expected), len(actual))
+        if len(expected) == 0 or len(actual) == 0:
+            continue
+        ious = box_iou(expected[:, :4], actual[:, :4])
+        best_iou, best_idx = ious.max(1)
+        same = (best_iou > iou) & (expected[:, 5] == actual[best_idx, 5])
+        matched += int(same.sum())
+        if same.any():
+            max_diff = max(max_diff, (expected[same, :4] - actual[best_idx[same], :4]).abs().max().item())
+    return max_diff, matched / total if total > 0 else 1.0
+
+# Размер входа, на котором обучался детектор (YOLO хранит его в аргументах чекпоинта)
+def model_imgsz(model: YOLO, default: int = 640) -> int:
+    imgsz = model.overrides.get("imgsz", default)
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    stride = int(max(model.model.stride)) if hasattr(model.model, "stride") else 32
+    return int(np.ceil(imgsz / stride) * stride)
+
+# Общая предобработка батча кадров для детекторов YOLO: letterbox, перестановка каналов, BCHW, 0..1.
+# Повторяет предобработку ultralytics для numpy-входа, поэтому результат детекции
+# совпадает с вызовом predict на исходных кадрах, но выполняется один раз на все детекторы.
+# Кадры с bgr_flags=True получают тот же тензор, что и их RGB-версия
+def preprocess_frames(images: list[np.ndarray], imgsz: int, device, bgr_flags: list[bool] = None,
+                      stride: int = 32, auto: bool = True) -> torch.Tensor:
+    bgr_flags = bgr_flags or [False] * len(images)
+    same_shapes = len({image.shape for image in images}) == 1
+    letterbox = LetterBox(imgsz, auto=same_shapes and auto, stride=stride)
+    batch = np.stack([
+        letterboxed if bgr else letterboxed[..., ::-1]
+        for image, bgr in zip(images, bgr_flags)
+        for letterboxed in [letterbox(image=image)]
+    ])
+    batch = np.ascontiguousarray(batch.transpose((0, 3, 1, 2)))
+    return torch.from_numpy(batch).to(device).float() / 255
+
+# Перевод рамок из координат letterbox-тензора в координаты исходного кадра
+def restore_boxes(boxes: torch.Tensor, tensor_shape, image_shape) -> np.ndarray:
+    return ops.scale_boxes(tensor_shape, boxes.clone(), image_shape).cpu().numpy()
+
+# Уменьшение кадра до рабочего разрешения с сохранением пропорций: длинная сторона кадра
+# вписывается в большую из сторон max_width x max_height, короткая - в меньшую, чтобы вертикальные
+# кадры не уменьшались сильнее горизонтальных. Кадр не увеличивается. Возвращает кадр и
+# коэффициенты (x, y) перевода рамок обратно в координаты исходного кадра
+def fit_frame(image: np.ndarray, max_width: int, max_height: int) -> tuple[np.ndarray, tuple[float, float]]:
+    height, width = image.shape[:2]
+    long_side, short_side = max(max_width, max_height), min(max_width, max_height)
+    scale = min(long_side / max(width, height), short_side / min(width, height))
+    if scale >= 1:
+        return image, (1.0, 1.0)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return resized, (width / size[0], height / size[1])
 
-    def detect(self, image):
-        results = self.model(image)
-        return results
\ No newline at end of file
+# Индексы классов модели по их названиям (например, только "car" из COCO)
+def class_ids(model: Detector, names: set[str]) -> list[int]:
+    return [idx for idx, name in model.names.items() if name.lower() in names]
@@ -0,0 +1,125 @@
+import os
+import sys
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from detector import (Detector, DETECTOR_BACKENDS, exported_path, write_metadata, detector_parity,
+                      preprocess_frames, restore_boxes)
+from classifier import (Classifier, CLASSIFIER_BACKENDS, export_classifier, classifier_parity,
+                        save_scripted, scripted_path, frame_to_tensor, crop_batch, crop_sizes)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+
+
+# Экспорт детекторов и классификатора в ONNX для бэкендов onnx и openvino (классификатора также
+# в TorchScript для бэкенда jit) и проверка совпадения их результатов с PyTorch:
+# python export_models.py [--check изображения] [--backend onnx|openvino].
+# При проверке код возврата 1, если хотя бы на одном изображении превышен допуск
+def parse_args():
+    parser = argparse.ArgumentParser(description="Экспорт моделей в ONNX и проверка совпадения с PyTorch")
+    parser.add_argument("--detector", default="best.pt", help="Веса детектора знаков")
+    parser.add_argument("--car-detector", default="yolov8s.pt", help="Веса детектора машин")
+    parser.add_argument("--classifier", default="resnet101_best_loss.pth", help="Веса классификатора")
+    parser.add_argument("--opset", type=int, default=17, help="Версия набора операций ONNX")
+    parser.add_argument("--backend", default="onnx", choices=["onnx", "openvino"],
+                        help="Бэкенд, на котором проверяется совпадение")
+    parser.add_argument("--check", nargs="*", default=None,
+                        help="Изображения или каталоги для проверки; без значений - только экспорт")
+    parser.add_argument("--skip-export", action="store_true", help="Только проверка уже экспортированных моделей")
+    parser.add_argument("--min-box-match", type=float, default=0.95,
+                        help="Минимальная доля совпавших рамок каждого детектора")
+    parser.add_argument("--max-box-diff", type=float, default=1.0,
+                        help="Максимальное расхождение координат совпавших рамок, px")
+    parser.add_argument("--max-logits-diff", type=float, default=0.01,
+                        help="Максимальное расхождение логитов классификатора")
+    parser.add_argument("--min-class-agreement", type=float, default=0.99,
+                        help="Минимальная доля совпавших классов классификатора")
+    return parser.parse_args()
+
+
+def export_detector(model_path: str, opset: int) -> Detector:
+    detector = Detector(model_path)
+    # dynamic: батч и размер letterbox-тензора меняются от запроса к запросу
+    onnx_path = detector.model.export(format="onnx", dynamic=True, opset=opset, imgsz=detector.imgsz)
+    target_path = exported_path(model_path)
+    if os.path.abspath(onnx_path) != os.path.abspath(target_path):
+        os.replace(onnx_path, target_path)
+    write_metadata(target_path, detector)
+    print(f"Детектор экспортирован: {model_path} -> {target_path}")
+    return detector
+
+
+def collect_images(paths: list[str]) -> list[str]:
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+            )
+        else:
+            images.append(path)
+    return images
+
+
+def main():
+    args = parse_args()
+
+    if not args.skip_export:
+        export_detector(args.detector, args.opset)
+        export_detector(args.car_detector, args.opset)
+        classifier_model = torch.load(args.classifier, map_location="cpu")
+        export_classifier(classifier_model, exported_path(args.classifier), opset=args.opset)
+        print(f"Классификатор экспортирован: {args.classifier} -> {exported_path(args.classifier)}")
+        save_scripted(classifier_model, args.classifier)
+        print(f"Классификатор сохранен в TorchScript: {args.classifier} -> {scripted_path(args.classifier)}")
+
+    if args.check is None:
+        return
+
+    # Сравнение на тех же тензорах, которые сервис подает моделям
+    torch_signs, torch_cars = Detector(args.detector), Detector(args.car_detector)
+    exported_signs = DETECTOR_BACKENDS[args.backend](args.detector)
+    exported_cars = DETECTOR_BACKENDS[args.backend](args.car_detector)
+    torch_classifier = Classifier(args.classifier, None)
+    exported_classifier = CLASSIFIER_BACKENDS[args.backend](args.classifier, None)
+
+    image_paths = collect_images(args.check)
+    if not image_paths:
+        print("Нет изображений для проверки")
+        return
+
+    failed = 0
+    for image_path in image_paths:
+        image = np.array(Image.open(image_path).convert("RGB"))
+        frames_tensor = preprocess_frames([image], torch_signs.imgsz, torch.device("cpu"), stride=torch_signs.stride)
+
+        signs_diff, signs_match = detector_parity(torch_signs, exported_signs, frames_tensor)
+        cars_diff, cars_match = detector_parity(torch_cars, exported_cars, frames_tensor)
+        line = (f"{os.path.basename(image_path)} | знаки: {signs_match * 100:.1f}% рамок, "
+                f"расхождение {signs_diff:.2f} px | машины: {cars_match * 100:.1f}% рамок, "
+                f"расхождение {cars_diff:.2f} px")
+        passed = (min(signs_match, cars_match) >= args.min_box_match
+                  and max(signs_diff, cars_diff) <= args.max_box_diff)
+
+        boxes = torch_signs.predict(frames_tensor, conf=0.5)[0][:, :4]
+        if len(boxes) > 0:
+            boxes = restore_boxes(boxes, frames_tensor.shape[2:], image.shape)
+            crops = crop_batch(frame_to_tensor(image, torch.device("cpu")), boxes,
+                               *crop_sizes(torch_classifier.input_size))
+            logits_diff, agreement = classifier_parity(torch_classifier, exported_classifier, crops)
+            line += f" | классификатор: {agreement * 100:.1f}% классов, расхождение логитов {logits_diff:.4f}"
+            passed = passed and agreement >= args.min_class_agreement and logits_diff <= args.max_logits_diff
+        if not passed:
+            failed += 1
+            line += " | превышен допуск"
+        print(line)
+
+    if failed:
+        print(f"Допуск превышен на {failed} из {len(image_paths)} изображений")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
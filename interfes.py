@@ -2,16 +2,130 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import threading
 import cv2
-import numpy as np
 from PIL import Image, ImageTk
-import requests
 import time
 from datetime import timedelta
 import os
-import json
-from collections import defaultdict
+import io
+from collections import OrderedDict
+from detection_client import (InferenceClient, DetectionCache, DetectionStore, ExportPipeline,
+                              draw_detections, write_report)
+# Максимальный объем кэша декодированных кадров, байт
+FRAME_CACHE_BYTES = 512 * 1024 * 1024
+# Число кадров, которые фоновый поток декодирует впереди текущей позиции
+PREFETCH_FRAMES = 32
+
+
+# LRU-кэш декодированных кадров с ограничением по суммарному объему в байтах
+class FrameCache:
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+
+    def get(self, index):
+        frame = self.frames.get(index)
+        if frame is not None:
+            self.frames.move_to_end(index)
+        return frame
+
+    # Кадры с номерами из keep не вытесняются
+    def put(self, index, frame, keep=()):
+        if index in self.frames:
+            self.size -= self.frames.pop(index).nbytes
+        self.frames[index] = frame
+        self.size += frame.nbytes
+        # Последний добавленный кадр не вытесняется, даже если он один больше лимита
+        while self.size > self.max_bytes:
+            evicted_index = next((i for i in self.frames if i != index and i not in keep), None)
+            if evicted_index is None:
+                break
+            self.size -= self.frames.pop(evicted_index).nbytes
+
+    def clear(self):
+        self.frames.clear()
+        self.size = 0
+
+
+# Фоновое последовательное чтение видео впереди текущей позиции. Все операции с VideoCapture
+# выполняются в одном потоке; перемотка (CAP_PROP_POS_FRAMES) нужна только при переходе
+# к кадру вне окна упреждающего чтения (слайдер, шаг назад за пределы кэша).
+# Окно упреждающего чтения не больше числа кадров, помещающихся в кэш, и кадры от текущего
+# до последнего прочитанного не вытесняются: иначе воспроизведение находило бы следующий кадр
+# вытесненным (по LRU показанные кадры новее прочитанных заранее) и перематывало видео
+class FrameReader:
+    def __init__(self, cap, total_frames, cache, prefetch=PREFETCH_FRAMES):
+        self.cap = cap
+        self.total_frames = total_frames
+        self.cache = cache
+        self.prefetch = prefetch
+        self.frame_bytes = None
+        self.condition = threading.Condition()
+        self.position = 0
+        self.playhead = 0
+        self.seek_to = None
+        self.end = total_frames
+        self.running = True
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.thread.start()
+
+    def get(self, index):
+        with self.condition:
+            self.playhead = index
+            frame = self.cache.get(index)
+            if frame is None and (index < self.position or index > self.position + self.prefetch):
+                self.seek_to = index
+            self.condition.notify_all()
+
+            while frame is None:
+                if not self.running or (index >= self.end and self.seek_to is None):
+                    return None
+                self.condition.wait(timeout=0.5)
+                frame = self.cache.get(index)
+            return frame
+
+    def needs_read(self):
+        if self.seek_to is not None:
+            return True
+        return self.position < self.end and self.position <= self.playhead + self.prefetch
+
+    def read_loop(self):
+        while True:
+            with self.condition:
+                while self.running and not self.needs_read():
+                    self.condition.wait()
+                if not self.running:
+                    return
+                if self.seek_to is not None:
+                    self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.seek_to)
+                    self.position = self.seek_to
+                    self.end = self.total_frames
+                    self.seek_to = None
+                index = self.position
+
+            ret, frame = self.cap.read()
+
+            with self.condition:
+                if self.seek_to is None:
+                    if ret:
+                        if self.frame_bytes is None:
+                            self.frame_bytes = frame.nbytes
+                            # В кэше помещаются кадр под курсором и prefetch + 1 кадров впереди
+                            self.prefetch = max(1, min(self.prefetch,
+                                                       self.cache.max_bytes // max(1, frame.nbytes) - 2))
+                        self.cache.put(index, frame, keep=range(self.playhead, index))
+                        self.position = index + 1
+                    else:
+                        # Видео закончилось раньше, чем указано в CAP_PROP_FRAME_COUNT, или кадр битый
+                        self.end = index
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout=1)
 
-API_URL = "http://localhost:8000/file"
 
 class VideoApp:
     def __init__(self, root):
@@ -74,6 +188,9 @@ class VideoApp:
         self.btn_generate_report = ttk.Button(control_frame, text="📄 Отчет", command=self.generate_report, state=tk.DISABLED)
         self.btn_generate_report.pack(side=tk.LEFT, padx=5)
 
+        self.btn_cancel_export = ttk.Button(control_frame, text="⛔ Отмена", command=self.cancel_export, state=tk.DISABLED)
+        self.btn_cancel_export.pack(side=tk.LEFT, padx=5)
+
         # --- Фильтры классов ---
         filter_frame = ttk.LabelFrame(root, text="Фильтры объектов")
         filter_frame.pack(fill=tk.X, padx=10, pady=5)
@@ -81,7 +198,7 @@ class VideoApp:
         self.available_classes = ["Additional information signs", "Car", "Forbidding signs", "Information signs", "Preliminary signs", "Priority signs", "Warning sings"]
         self.class_vars = {}
         self.class_filters = set(self.available_classes)
-        self.detection_data = []
+        self.detection_store = DetectionStore()
 
         for cls in self.available_classes:
             var = tk.BooleanVar(value=True)
@@ -103,11 +220,15 @@ class VideoApp:
         self.frame_width = 0
         self.frame_height = 0
         self.current_frame_idx = 0
-        self.frame_cache = []
+        self.frame_cache = FrameCache()
+        self.frame_reader = None
+        self.detection_cache = None
+        self.export = None
         self.playing = False
         self.thread = None
         self.last_frame_time = 0
         self.output_video = None
+        self.client = InferenceClient()
 
     
     def update_status(self, message):
@@ -135,8 +256,14 @@ class VideoApp:
         self.frame_width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.frame_height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.current_frame_idx = 0
-        self.frame_cache = [None] * self.total_frames
-        self.detection_data = []  # Очищаем данные детекции
+        self.frame_cache.clear()
+        self.frame_reader = FrameReader(self.cap, self.total_frames, self.frame_cache)
+        self.detection_store.clear()  # Очищаем данные детекции
+
+        # Результаты детекции прошлых просмотров этого видео той же версией моделей
+        self.detection_cache = DetectionCache(self.video_path, self.client.model_version())
+        for frame_idx, objects in self.detection_cache.items():
+            self.record_detections(frame_idx, objects)
         
         self.btn_start.config(state=tk.NORMAL)
         self.btn_pause.config(state=tk.DISABLED)
@@ -206,44 +333,18 @@ class VideoApp:
                 if not output_path:
                     return
                 
-                # Определяем кодек
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v') if output_path.endswith('.mp4') else cv2.VideoWriter_fourcc(*'XVID')
-                
                 # Рассчитываем кадры для отрезка
                 start_frame = int(start_time * self.fps)
                 end_frame = int(end_time * self.fps)
                 
-                self.update_status(f"Сохранение отрезка {start_time}s-{end_time}s...")
-                self.root.update()
-                
-                # Создаем объект для записи видео
-                out = cv2.VideoWriter(output_path, fourcc, self.fps, (self.frame_width, self.frame_height))
-                
-                # Обрабатываем и сохраняем каждый кадр отрезка
-                for i in range(start_frame, end_frame + 1):
-                    frame = self.get_frame(i)
-                    if frame is None:
-                        continue
-                    
-                    annotated_frame = self.annotate_frame(frame.copy())
-                    out.write(annotated_frame)
-                    
-                    # Обновляем прогресс
-                    if i % 10 == 0:
-                        progress = (i - start_frame + 1) / (end_frame - start_frame + 1) * 100
-                        self.update_status(f"Сохранение отрезка... {progress:.1f}% завершено")
-                        self.root.update()
-                
-                out.release()
-                self.update_status(f"Отрезок успешно сохранен: {os.path.basename(output_path)}")
-                messagebox.showinfo("Успех", f"Отрезок видео успешно сохранен:\n{output_path}")
+                # Обработка и запись отрезка выполняются в фоне, окно ввода закрываем сразу
                 segment_window.destroy()
+                self.start_export(output_path, start_frame, min(end_frame + 1, self.total_frames),
+                                  f"Сохранение отрезка {start_time}s-{end_time}s", "Отрезок видео успешно сохранен")
                 
             except Exception as e:
                 self.update_status("Ошибка при сохранении отрезка")
                 messagebox.showerror("Ошибка", f"Не удалось сохранить отрезок:\n{str(e)}")
-                if 'out' in locals():
-                    out.release()
         
         ttk.Button(segment_window, text="Сохранить", command=save_segment).pack(pady=10)
     
@@ -252,42 +353,16 @@ class VideoApp:
             messagebox.showwarning("Ошибка", "Сначала загрузите видео")
             return
         
-        # Анализируем данные детекции по минутам
-        report_data = defaultdict(lambda: defaultdict(int))
-        
-        for frame_data in self.detection_data:
-            frame_time = frame_data['frame_time']
-            minute = int(frame_time // 60)
-            
-            for obj in frame_data['objects']:
-                class_name = obj['class_name']
-                report_data[minute][class_name] += 1
-        
-        # Создаем текстовый отчет
-        report_text = "Отчет по видео:\n\n"
-        report_text += f"Видео: {os.path.basename(self.video_path)}\n"
-        report_text += f"Длительность: {str(timedelta(seconds=self.duration))}\n\n"
-        report_text += "Детекция по минутам:\n"
-        
-        for minute in sorted(report_data.keys()):
-            report_text += f"\nМинута {minute}:\n"
-            for class_name, count in report_data[minute].items():
-                report_text += f"  {class_name}: {count}\n"
-        
-        # Создаем JSON структуру
-        report_json = {
-            "video_file": os.path.basename(self.video_path),
-            "duration": str(timedelta(seconds=self.duration)),
-            "detection_data": {f"minute_{minute}": dict(report_data[minute]) 
-                            for minute in sorted(report_data.keys())}
-        }
-        
-        # Создаем CSV данные
-        csv_lines = ["Минута,Класс,Количество"]
-        for minute in sorted(report_data.keys()):
-            for class_name, count in report_data[minute].items():
-                csv_lines.append(f"{minute},{class_name},{count}")
-        report_csv = "\n".join(csv_lines)
+        # Счетчики по минутам уже накоплены в хранилище детекций
+        video_name = os.path.basename(self.video_path)
+        minute_counts = self.detection_store.minute_snapshot()
+
+        def render_report(fmt):
+            buffer = io.StringIO()
+            write_report(buffer, fmt, video_name, self.duration, minute_counts)
+            return buffer.getvalue()
+
+        report_text = render_report("txt")
         
         # Показываем отчет в новом окне
         report_window = tk.Toplevel(self.root)
@@ -322,12 +397,7 @@ class VideoApp:
             self.text_widget.config(state=tk.NORMAL)
             self.text_widget.delete(1.0, tk.END)
             
-            if self.report_format.get() == "txt":
-                self.text_widget.insert(tk.END, report_text)
-            elif self.report_format.get() == "json":
-                self.text_widget.insert(tk.END, json.dumps(report_json, indent=4, ensure_ascii=False))
-            elif self.report_format.get() == "csv":
-                self.text_widget.insert(tk.END, report_csv)
+            self.text_widget.insert(tk.END, render_report(self.report_format.get()))
             
             self.text_widget.config(state=tk.DISABLED)
         
@@ -359,12 +429,7 @@ class VideoApp:
             
             try:
                 with open(file_path, 'w', encoding='utf-8') as f:
-                    if fmt == "txt":
-                        f.write(report_text)
-                    elif fmt == "json":
-                        json.dump(report_json, f, indent=4, ensure_ascii=False)
-                    elif fmt == "csv":
-                        f.write(report_csv)
+                    write_report(f, fmt, video_name, self.duration, minute_counts)
                 
                 messagebox.showinfo("Успех", f"Отчет сохранен в формате {fmt.upper()}:\n{file_path}")
             except Exception as e:
@@ -386,36 +451,54 @@ class VideoApp:
         if not output_path:
             return
         
+        self.start_export(output_path, 0, self.total_frames, "Сохранение видео", "Видео успешно сохранено")
+
+    def start_export(self, output_path, start_frame, end_frame, title, success_message):
         fourcc = cv2.VideoWriter_fourcc(*'mp4v') if output_path.endswith('.mp4') else cv2.VideoWriter_fourcc(*'XVID')
-        
-        try:
-            self.update_status("Сохранение видео... Пожалуйста, подождите")
-            self.root.update()
-            
-            out = cv2.VideoWriter(output_path, fourcc, self.fps, (self.frame_width, self.frame_height))
-            
-            for i in range(self.total_frames):
-                frame = self.get_frame(i)
-                if frame is None:
-                    continue
-                
-                annotated_frame = self.annotate_frame(frame.copy())
-                out.write(annotated_frame)
-                
-                if i % 10 == 0:
-                    progress = (i + 1) / self.total_frames * 100
-                    self.update_status(f"Сохранение видео... {progress:.1f}% завершено")
-                    self.root.update()
-            
-            out.release()
-            self.update_status(f"Видео успешно сохранено: {os.path.basename(output_path)}")
-            messagebox.showinfo("Успех", f"Видео успешно сохранено:\n{output_path}")
-            
-        except Exception as e:
-            self.update_status("Ошибка при сохранении видео")
-            messagebox.showerror("Ошибка", f"Не удалось сохранить видео:\n{str(e)}")
-            if 'out' in locals():
-                out.release()
+        self.export = ExportPipeline(
+            self.video_path, start_frame, end_frame, output_path, fourcc, self.fps,
+            (self.frame_width, self.frame_height), self.client, self.detection_cache, self.annotate_exported
+        )
+        self.set_export_state(True)
+        self.update_status(f"{title}... Пожалуйста, подождите")
+        self.export.start()
+        self.root.after(200, lambda: self.poll_export(title, success_message))
+
+    # Отрисовка кадра в стадии конвейера экспорта
+    def annotate_exported(self, frame_idx, frame, objects):
+        if objects is not None:
+            self.store_detections(frame_idx, objects)
+        return self.draw_detections(frame, objects or [])
+
+    # Прогресс экспорта опрашивается из цикла Tk, интерфейс при этом не блокируется
+    def poll_export(self, title, success_message):
+        export = self.export
+        if not export.done():
+            self.update_status(f"{title}... {export.progress():.1f}% завершено | {export.throughput():.1f} кадр/с")
+            self.root.after(200, lambda: self.poll_export(title, success_message))
+            return
+
+        self.export = None
+        self.set_export_state(False)
+        output_name = os.path.basename(export.output_path)
+        if export.error is not None:
+            self.update_status(f"Ошибка: {title.lower()}")
+            messagebox.showerror("Ошибка", f"Не удалось сохранить видео:\n{str(export.error)}")
+        elif export.cancelled.is_set():
+            self.update_status(f"Экспорт отменен: {output_name} ({export.frames_written} кадров)")
+        else:
+            self.update_status(f"{success_message}: {output_name} | {export.throughput():.1f} кадр/с")
+            messagebox.showinfo("Успех", f"{success_message}:\n{export.output_path}")
+
+    def cancel_export(self):
+        if self.export is not None:
+            self.export.cancel()
+
+    def set_export_state(self, running):
+        state = tk.DISABLED if running else tk.NORMAL
+        for button in (self.btn_load, self.btn_start, self.btn_save, self.btn_save_segment, self.btn_generate_report):
+            button.config(state=state)
+        self.btn_cancel_export.config(state=tk.NORMAL if running else tk.DISABLED)
     
     def start_playback(self):
         if self.playing:
@@ -445,7 +528,7 @@ class VideoApp:
             if frame is None:
                 break
 
-            annotated = self.annotate_frame(frame.copy())
+            annotated = self.annotate_frame(frame.copy(), self.current_frame_idx)
             
             self.root.after(0, lambda: self.show_image(annotated))
             self.root.after(0, self.update_frame_info)
@@ -507,14 +590,9 @@ class VideoApp:
         )
     
     def get_frame(self, index):
-        if index < 0 or index >= self.total_frames:
+        if index < 0 or index >= self.total_frames or self.frame_reader is None:
             return None
-        if self.frame_cache[index] is None:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
-            ret, frame = self.cap.read()
-            if ret:
-                self.frame_cache[index] = frame
-        return self.frame_cache[index]
+        return self.frame_reader.get(index)
     
     def show_frame_by_index(self, index):
         frame = self.get_frame(index)
@@ -527,51 +605,40 @@ class VideoApp:
         if int(self.slider.get()) != index:
             self.slider.set(index)
 
-        annotated = self.annotate_frame(frame.copy())
+        annotated = self.annotate_frame(frame.copy(), index)
         self.show_image(annotated)
             
-    def annotate_frame(self, frame):
-        try:
-            _, img_encoded = cv2.imencode('.jpg', frame)
-            files = {'image': ('frame.jpg', img_encoded.tobytes(), 'image/jpeg')}
-            response = requests.post(API_URL, files=files)
-            response.raise_for_status()
-            data = response.json()
-
-            # Сохраняем данные детекции
-            frame_time = self.current_frame_idx / self.fps if self.fps > 0 else 0
-            frame_data = {
-                'frame_idx': self.current_frame_idx,
-                'frame_time': frame_time,
-                'objects': data.get("objects", [])
-            }
-            self.detection_data.append(frame_data)
-
-            # Размер кадра
-            h, w, _ = frame.shape
-
-            for obj in data.get("objects", []):
-                label = obj['class_name']
+    def annotate_frame(self, frame, frame_idx=None):
+        if frame_idx is None:
+            frame_idx = self.current_frame_idx
 
-                # Временно отключаем фильтрацию классов
-                if label not in self.class_filters:
-                    continue
+        # Перерисовка уже обработанного кадра не требует запроса к серверу
+        objects = self.detection_cache.get(frame_idx) if self.detection_cache is not None else None
+        if objects is None:
+            try:
+                objects = self.client.detect(frame)
+            except Exception as e:
+                print("Ошибка при запросе к серверу:", e)
+                return frame
+            self.store_detections(frame_idx, objects)
 
-                # Координаты — обрезаем по границам кадра
-                xtl = max(0, min(int(obj['xtl']), w - 1))
-                ytl = max(0, min(int(obj['ytl']), h - 1))
-                xbr = max(0, min(int(obj['xbr']), w - 1))
-                ybr = max(0, min(int(obj['ybr']), h - 1))
+        return self.draw_detections(frame, objects)
 
-                # Отрисовка прямоугольника и подписи
-                cv2.rectangle(frame, (xtl, ytl), (xbr, ybr), (0, 0, 255), 2)
-                cv2.putText(frame, label, (xtl, max(ytl - 10, 0)),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+    # Новый результат детекции попадает в кэш и в данные отчета ровно один раз
+    def store_detections(self, frame_idx, objects):
+        if self.detection_cache is not None:
+            if self.detection_cache.get(frame_idx) is not None:
+                return
+            self.detection_cache.put(frame_idx, objects)
+        self.record_detections(frame_idx, objects)
 
-        except Exception as e:
-            print("Ошибка при запросе к серверу:", e)
+    def record_detections(self, frame_idx, objects):
+        # Сохраняем данные детекции (повторные кадры хранилище пропускает)
+        frame_time = frame_idx / self.fps if self.fps > 0 else 0
+        self.detection_store.add(frame_idx, frame_time, objects)
 
-        return frame
+    def draw_detections(self, frame, objects):
+        return draw_detections(frame, objects, self.class_filters)
 
     
     def show_image(self, frame):
@@ -588,6 +655,12 @@ class VideoApp:
     
     def stop_playback(self):
         self.pause_playback()
+        if self.frame_reader is not None:
+            self.frame_reader.close()
+            self.frame_reader = None
+        if self.detection_cache is not None:
+            self.detection_cache.close()
+            self.detection_cache = None
         if self.cap is not None:
             self.cap.release()
             self.cap = None
@@ -0,0 +1,289 @@
+import os
+import json
+import queue
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+import cv2
+import numpy as np
+from datacontract.job_status import JobStatus
+from datacontract.service_output import ServiceOutput
+from tracking import KeyframeTracker
+from motion_gate import MotionGate
+
+logger = logging.getLogger(__name__)
+
+# Период проверки jobs_dir на задачи, созданные другими процессами сервиса, секунд
+JOB_POLL_INTERVAL = 1.0
+
+# Менеджер задач обработки видео на стороне сервиса. Для каждой задачи в jobs_dir/<job_id>
+# хранятся job.json (состояние и контрольная точка) и detections.jsonl (по строке на кадр).
+# Контрольная точка содержит число готовых кадров и размер detections.jsonl на этот момент,
+# поэтому прерванная задача продолжается с последнего сохраненного кадра.
+# При нескольких процессах сервиса задачи выполняет только один из них (runner): остальные
+# сохраняют новые задачи и запросы на повтор в job.json, runner находит их, проверяя jobs_dir,
+# а состояние задач, которые процесс не выполняет сам, читается с диска (прогресс - на момент
+# последней контрольной точки)
+class JobManager:
+    def __init__(self, jobs_dir: str, run_batch: Callable[[list[np.ndarray]], list[ServiceOutput]],
+                 batch_size: int, checkpoint_every: int,
+                 make_tracker: Optional[Callable[[], KeyframeTracker]] = None,
+                 make_motion_gate: Optional[Callable[[], MotionGate]] = None,
+                 runner: bool = True):
+        self.jobs_dir = jobs_dir
+        self.runner = runner
+        # run_batch принимает кадры OpenCV в порядке BGR
+        self.run_batch = run_batch
+        self.batch_size = max(1, batch_size)
+        self.checkpoint_every = max(1, checkpoint_every)
+        # Создает трекер для задач в режиме трекинга
+        self.make_tracker = make_tracker
+        # Создает фильтр статичных кадров для задач с motion_gate
+        self.make_motion_gate = make_motion_gate
+        self.jobs: dict[str, JobStatus] = {}
+        self.checkpoints: dict[str, tuple[int, int]] = {}
+        # Задачи в очереди или в обработке этим процессом
+        self.active: set[str] = set()
+        self.lock = threading.Lock()
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def results_path(self, job_id: str) -> str:
+        return os.path.join(self.job_dir(job_id), "detections.jsonl")
+
+    def start(self):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        if not self.runner:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="video-jobs", daemon=True)
+        self.thread.start()
+        # Незавершенные задачи предыдущего запуска продолжаются с контрольной точки
+        self._scan()
+
+    # Постановка в очередь задач из jobs_dir, ожидающих обработки: незавершенных задач прошлого
+    # запуска, а также созданных или повторно запущенных другими процессами
+    def _scan(self):
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            with self.lock:
+                known = self.jobs.get(job_id)
+                if job_id in self.active or (known is not None and known.status == "completed"):
+                    continue
+            loaded = self._load_state(job_id)
+            if loaded is None:
+                continue
+            job, checkpoint = loaded
+            with self.lock:
+                self.jobs[job_id] = job
+                self.checkpoints[job_id] = checkpoint
+                if job.status not in ("queued", "running"):
+                    continue
+                self.active.add(job_id)
+            logger.info(f"Запуск задачи {job_id} с кадра {job.completed_frames}")
+            job.status = "queued"
+            self.queue.put(job_id)
+
+    # Состояние задачи и контрольная точка из job.json; None, если задачи нет
+    def _load_state(self, job_id: str) -> Optional[tuple[JobStatus, tuple[int, int]]]:
+        state_path = os.path.join(self.job_dir(job_id), "job.json")
+        try:
+            with open(state_path, "r") as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        job = JobStatus(**state["job"])
+        checkpoint = (state.get("checkpoint_frames", 0), state.get("checkpoint_offset", 0))
+        job.completed_frames = checkpoint[0]
+        return job, checkpoint
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+            self.thread = None
+
+    def submit(self, video_path: str, job_id: str = None, tracking: bool = False,
+               motion_gate: bool = False) -> JobStatus:
+        job_id = job_id or uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        job = JobStatus(job_id=job_id, video_path=video_path, tracking=tracking, motion_gate=motion_gate)
+        if not self.runner:
+            self._save_state(job, (0, 0))
+            return job
+        with self.lock:
+            self.jobs[job_id] = job
+            self.checkpoints[job_id] = (0, 0)
+            self.active.add(job_id)
+        self._save_state(job)
+        self.queue.put(job_id)
+        return job
+
+    # Повторный запуск упавшей задачи с последней контрольной точки
+    def resume(self, job_id: str) -> JobStatus:
+        job = self.get(job_id)
+        if job is None or job.status != "failed":
+            return job
+        if not self.runner:
+            job, checkpoint = self._load_state(job_id)
+            job.status = "queued"
+            job.error = None
+            self._save_state(job, checkpoint)
+            return job
+        with self.lock:
+            self.active.add(job_id)
+        job.status = "queued"
+        job.error = None
+        job.completed_frames = self.checkpoints[job_id][0]
+        self._save_state(job)
+        self.queue.put(job_id)
+        return job
+
+    # Задачи, которые выполняет этот процесс, берутся из памяти, остальные - из job.json
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        if self.runner:
+            with self.lock:
+                job = self.jobs.get(job_id)
+            if job is not None:
+                return job
+        loaded = self._load_state(job_id)
+        return loaded[0] if loaded is not None else None
+
+    def list(self) -> list[JobStatus]:
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        jobs = [self.get(job_id) for job_id in sorted(os.listdir(self.jobs_dir))]
+        return [job for job in jobs if job is not None]
+
+    def _save_state(self, job: JobStatus, checkpoint: Optional[tuple[int, int]] = None):
+        checkpoint_frames, checkpoint_offset = checkpoint or self.checkpoints[job.job_id]
+        state = {
+            "job": job.model_dump(mode="json", exclude={"progress"}),
+            "checkpoint_frames": checkpoint_frames,
+            "checkpoint_offset": checkpoint_offset
+        }
+        state_path = os.path.join(self.job_dir(job.job_id), "job.json")
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump(state, state_file, indent=4)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_path, state_path)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                job_id = self.queue.get(timeout=JOB_POLL_INTERVAL)
+            except queue.Empty:
+                self._scan()
+                continue
+            if job_id is None:
+                break
+            job = self.get(job_id)
+            try:
+                self._process(job)
+            except Exception as e:
+                logger.exception(f"Ошибка при обработке задачи {job_id}")
+                job.status = "failed"
+                job.error = str(e)
+                self._save_state(job)
+            finally:
+                with self.lock:
+                    self.active.discard(job_id)
+
+    def _process(self, job: JobStatus):
+        cap = cv2.VideoCapture(job.video_path)
+        if not cap.isOpened():
+            raise RuntimeError(f"Не удалось открыть видео: {job.video_path}")
+
+        job.total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        job.fps = cap.get(cv2.CAP_PROP_FPS)
+        job.status = "running"
+
+        # Отбрасываем строки, записанные после последней контрольной точки
+        frame_idx, offset = self.checkpoints[job.job_id]
+        results_path = self.results_path(job.job_id)
+        with open(results_path, "ab") as results_file:
+            results_file.truncate(offset)
+
+        job.completed_frames = frame_idx
+        if frame_idx > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        self._save_state(job)
+
+        # После возобновления трекинг начинается с ключевого кадра, нумерация треков - заново
+        tracker = self.make_tracker() if job.tracking and self.make_tracker is not None else None
+        gate = self.make_motion_gate() if job.motion_gate and self.make_motion_gate is not None else None
+
+        # Инференс одного кадра; в режимах трекинга и пропуска статичных кадров кадры идут по одному
+        def infer(frame: np.ndarray) -> ServiceOutput:
+            if gate is not None:
+                return gate.step(frame, lambda part: self.run_batch([part])[0])
+            return self.run_batch([frame])[0]
+
+        started = time.perf_counter()
+        processed = 0
+        since_checkpoint = 0
+        with open(results_path, "ab") as results_file:
+            while not self.stopping.is_set():
+                frames = []
+                while len(frames) < self.batch_size:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    frames.append(frame)
+                if not frames:
+                    break
+
+                if tracker is not None:
+                    outputs = [tracker.step(frame, infer) for frame in frames]
+                elif gate is not None:
+                    outputs = [infer(frame) for frame in frames]
+                else:
+                    outputs = self.run_batch(frames)
+
+                lines = []
+                for output in outputs:
+                    frame_time = frame_idx / job.fps if job.fps > 0 else 0
+                    lines.append(
+                        f'{{"frame_idx": {frame_idx}, "frame_time": {frame_time:.3f}, '
+                        f'"objects": {json.dumps(output.model_dump(mode="json")["objects"])}}}\n'
+                    )
+                    frame_idx += 1
+                results_file.write("".join(lines).encode("utf-8"))
+
+                processed += len(frames)
+                since_checkpoint += len(frames)
+                job.completed_frames = frame_idx
+                job.processing_fps = processed / (time.perf_counter() - started)
+
+                if since_checkpoint >= self.checkpoint_every:
+                    self._checkpoint(job, results_file, frame_idx)
+                    since_checkpoint = 0
+
+            self._checkpoint(job, results_file, frame_idx)
+
+        cap.release()
+        if not self.stopping.is_set():
+            job.status = "completed"
+            job.total_frames = max(job.total_frames, frame_idx)
+            self._save_state(job)
+            logger.info(f"Задача {job.job_id} завершена: {frame_idx} кадров, {job.processing_fps:.1f} к/с")
+            if tracker is not None:
+                logger.info(f"Задача {job.job_id}: ключевых кадров {tracker.keyframes} из {tracker.frames}")
+            if gate is not None:
+                logger.info(f"Задача {job.job_id}: без инференса {gate.reused} кадров из {gate.frames}, "
+                            f"частично {gate.partial}")
+
+    # Контрольная точка: сначала результаты сбрасываются на диск, затем фиксируется состояние
+    def _checkpoint(self, job: JobStatus, results_file, frame_idx: int):
+        results_file.flush()
+        os.fsync(results_file.fileno())
+        self.checkpoints[job.job_id] = (frame_idx, results_file.tell())
+        self._save_state(job)
@@ -0,0 +1,127 @@
+import bisect
+import multiprocessing
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм длительности, секунд
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Этапы обработки запроса: чтение загрузки, декодирование, ожидание в очереди батчей, предобработка кадров,
+# детекция знаков, вырезка знаков, классификация, детекция машин, отрисовка, сериализация ответа
+# и запись журнала результатов. Этапы конвейера моделей измеряются на батч, а не на кадр
+STAGES = (
+    "read", "decode", "queue", "preprocess", "sign_detection", "crop", "classification",
+    "car_detection", "render", "serialization", "write"
+)
+
+# Метрики в текстовом формате Prometheus. Значения хранятся в разделяемой памяти, созданной при
+# импорте модуля: процессы сервиса, созданные через fork, пишут в общие счетчики, и /metrics
+# любого процесса отдает суммарные значения
+REGISTRY = []
+# Запись наблюдений в текущем процессе; отключается на время прогрева моделей
+recording = True
+
+
+# Гистограмма с необязательной меткой; значения метки задаются заранее, чтобы выделить память до fork
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets, label: str = None, label_values=("",)):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        self.label = label
+        self.label_values = list(label_values)
+        self.offsets = {value: idx * (len(self.buckets) + 2) for idx, value in enumerate(self.label_values)}
+        # На каждое значение метки: число наблюдений по корзинам (не накопительно), общее число и сумма
+        self.values = multiprocessing.RawArray("d", len(self.label_values) * (len(self.buckets) + 2))
+        self.lock = multiprocessing.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, label_value: str = ""):
+        if not recording:
+            return
+        offset = self.offsets[label_value]
+        bucket = bisect.bisect_left(self.buckets, value)
+        count = len(self.buckets)
+        with self.lock:
+            if bucket < count:
+                self.values[offset + bucket] += 1
+            self.values[offset + count] += 1
+            self.values[offset + count + 1] += value
+
+    # Замер длительности блока кода
+    @contextmanager
+    def time(self, label_value: str = ""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, label_value)
+
+    def expose(self) -> list[str]:
+        with self.lock:
+            values = list(self.values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        count = len(self.buckets)
+        for label_value, offset in self.offsets.items():
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for idx, bound in enumerate(self.buckets):
+                cumulative += values[offset + idx]
+                lines.append(f'{self.name}_bucket{{{labels}le="{float(bound)!r}"}} {cumulative:.0f}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {values[offset + count]:.0f}')
+            suffix = f"{{{labels.rstrip(',')}}}" if self.label else ""
+            lines.append(f"{self.name}_sum{suffix} {values[offset + count + 1]!r}")
+            lines.append(f"{self.name}_count{suffix} {values[offset + count]:.0f}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = multiprocessing.RawValue("d", 0.0)
+        self.lock = multiprocessing.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def expose(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.value.value!r}",
+        ]
+
+
+# Наблюдения внутри блока не записываются: прогревочные батчи не должны попадать в метрики
+@contextmanager
+def paused():
+    global recording
+    recording = False
+    try:
+        yield
+    finally:
+        recording = True
+
+
+# Все метрики в текстовом формате Prometheus (text/plain; version=0.0.4)
+def expose() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.expose()) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "inference_stage_seconds", "Длительность этапа обработки, секунд", LATENCY_BUCKETS, "stage", STAGES
+)
+REQUEST_SECONDS = Histogram(
+    "inference_request_seconds", "Полное время обработки запроса /file и /raw, секунд", LATENCY_BUCKETS
+)
+BATCH_SIZE = Histogram("inference_batch_size", "Число изображений в батче инференса", (1, 2, 4, 8, 16, 32, 64))
+OBJECTS_PER_FRAME = Histogram(
+    "inference_objects_per_frame", "Число найденных объектов на кадре", (0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+QUEUE_DEPTH = Gauge("inference_queue_depth", "Число изображений, ожидающих инференса (по всем процессам)")
@@ -0,0 +1,130 @@
+from typing import Callable, Optional
+import cv2
+import numpy as np
+from datacontract.service_output import ServiceOutput
+
+
+# Пропуск инференса для статичных кадров неподвижной камеры.
+# Кадр уменьшается до width пикселей по ширине и сравнивается с опорным кадром (последним
+# обработанным) по ячейкам сетки grid x grid. Пиксель считается изменившимся, если разность яркости
+# больше threshold, ячейка - если таких пикселей больше min_changed ее площади. Если изменившихся
+# ячеек нет, возвращается предыдущий ServiceOutput. Иначе инференс выполняется только для
+# прямоугольника изменившихся ячеек, а объекты вне него берутся из предыдущего результата;
+# если изменения занимают больше max_region площади кадра, обрабатывается весь кадр.
+# Состояние относится к одному потоку кадров, кадры подаются строго по порядку
+class MotionGate:
+    def __init__(self, threshold: float = 20.0, min_changed: float = 0.02, grid: int = 8,
+                 max_region: float = 0.5, width: int = 160, bgr: bool = False):
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.grid = max(1, grid)
+        self.max_region = max_region
+        self.width = width
+        self.bgr = bgr
+        self.reference = None
+        self.pending = None
+        self.output: Optional[ServiceOutput] = None
+        self.frames = 0
+        self.reused = 0
+        self.partial = 0
+
+    def small(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        size = (min(self.width, width), max(1, round(height * min(self.width, width) / width)))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY if self.bgr else cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    # Один шаг: infer вызывается для кадра или его изменившейся части
+    def step(self, frame: np.ndarray, infer: Callable[[np.ndarray], ServiceOutput]) -> ServiceOutput:
+        region = self.check(frame)
+        if region is None:
+            return self.output
+        return self.update(frame, region, infer(crop(frame, region)))
+
+    # Область кадра (x1, y1, x2, y2), которую нужно обработать, или None, если кадр не изменился
+    def check(self, frame: np.ndarray) -> Optional[tuple[int, int, int, int]]:
+        self.frames += 1
+        small = self.small(frame)
+        self.pending = small
+        height, width = frame.shape[:2]
+        full = (0, 0, width, height)
+        if self.output is None or self.reference is None or self.reference.shape != small.shape:
+            return full
+
+        # Доля изменившихся пикселей по ячейкам сетки
+        diff = np.abs(small - self.reference) > self.threshold
+        rows = np.array_split(np.arange(small.shape[0]), self.grid)
+        cols = np.array_split(np.arange(small.shape[1]), self.grid)
+        changed = np.array([
+            [diff[r[0]:r[-1] + 1, c[0]:c[-1] + 1].mean() > self.min_changed for c in cols if len(c)]
+            for r in rows if len(r)
+        ])
+        if not changed.any():
+            self.reused += 1
+            return None
+
+        # Прямоугольник изменившихся ячеек с запасом в одну ячейку по краям
+        changed_rows = np.flatnonzero(changed.any(axis=1))
+        changed_cols = np.flatnonzero(changed.any(axis=0))
+        row_bounds = [r[0] for r in rows if len(r)] + [small.shape[0]]
+        col_bounds = [c[0] for c in cols if len(c)] + [small.shape[1]]
+        y1 = row_bounds[max(changed_rows[0] - 1, 0)]
+        y2 = row_bounds[min(changed_rows[-1] + 2, len(row_bounds) - 1)]
+        x1 = col_bounds[max(changed_cols[0] - 1, 0)]
+        x2 = col_bounds[min(changed_cols[-1] + 2, len(col_bounds) - 1)]
+
+        scale_x, scale_y = width / small.shape[1], height / small.shape[0]
+        x1, y1 = int(x1 * scale_x), int(y1 * scale_y)
+        x2, y2 = min(width, int(np.ceil(x2 * scale_x))), min(height, int(np.ceil(y2 * scale_y)))
+
+        # Область расширяется до объектов, которые она задевает, чтобы они не оказались обрезаны
+        for obj in self.output.objects:
+            if obj.xbr > x1 and obj.xtl < x2 and obj.ybr > y1 and obj.ytl < y2:
+                x1, y1 = max(0, min(x1, obj.xtl)), max(0, min(y1, obj.ytl))
+                x2, y2 = min(width, max(x2, obj.xbr)), min(height, max(y2, obj.ybr))
+
+        if (y2 - y1) * (x2 - x1) > self.max_region * width * height:
+            return full
+        return x1, y1, x2, y2
+
+    # Объединение результата инференса области с объектами предыдущего кадра вне этой области
+    def update(self, frame: np.ndarray, region: tuple[int, int, int, int], output: ServiceOutput) -> ServiceOutput:
+        x1, y1, x2, y2 = region
+        height, width = frame.shape[:2]
+        if region == (0, 0, width, height):
+            self.output = output
+            self.reference = self.pending
+        else:
+            kept = [
+                obj for obj in self.output.objects
+                if obj.xbr <= x1 or obj.xtl >= x2 or obj.ybr <= y1 or obj.ytl >= y2
+            ]
+            # Номера объектов области нумеруются после номеров оставленных объектов,
+            # иначе они совпали бы с номерами объектов предыдущего результата
+            first_id = max((obj.tracked_id for obj in kept), default=-1) + 1
+            found = [
+                obj.model_copy(update={
+                    "xtl": obj.xtl + x1, "ytl": obj.ytl + y1,
+                    "xbr": obj.xbr + x1, "ybr": obj.ybr + y1,
+                    "tracked_id": first_id + i
+                })
+                for i, obj in enumerate(output.objects)
+            ]
+            self.output = self.output.model_copy(update={"objects": kept + found})
+            self.partial += 1
+
+            # Опорный кадр обновляется только в обработанной области
+            scale_x, scale_y = self.pending.shape[1] / width, self.pending.shape[0] / height
+            sy1, sy2 = int(y1 * scale_y), int(np.ceil(y2 * scale_y))
+            sx1, sx2 = int(x1 * scale_x), int(np.ceil(x2 * scale_x))
+            self.reference[sy1:sy2, sx1:sx2] = self.pending[sy1:sy2, sx1:sx2]
+        self.pending = None
+        return self.output
+
+
+# Часть кадра для инференса; детекторам нужен непрерывный массив
+def crop(frame: np.ndarray, region: tuple[int, int, int, int]) -> np.ndarray:
+    x1, y1, x2, y2 = region
+    if (x1, y1) == (0, 0) and (y2, x2) == frame.shape[:2]:
+        return frame
+    return np.ascontiguousarray(frame[y1:y2, x1:x2])
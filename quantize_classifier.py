@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import torch
+import torchvision.datasets as dataset
+from torch.utils.data import DataLoader
+from classifier import Classifier, QuantizedClassifier, quantize_classifier, save_quantized, quantized_path
+from Resnet101.ResNet101 import train_path, test_path
+
+
+# Квантование классификатора в INT8 и сравнение с FP32 на тестовой выборке ImageFolder:
+# точность, совпадение классов и задержка на одну вырезку. Код возврата 1, если точность
+# упала больше чем на --max-drop процентных пунктов
+def parse_args():
+    parser = argparse.ArgumentParser(description="INT8-квантование классификатора и проверка точности")
+    parser.add_argument("--classifier", default="resnet101_best_loss.pth", help="Веса FP32-классификатора")
+    parser.add_argument("--test-dir", default=test_path, help="Тестовая выборка (ImageFolder)")
+    parser.add_argument("--calibration-dir", default=train_path, help="Выборка для калибровки (ImageFolder)")
+    parser.add_argument("--calibration-batches", type=int, default=32, help="Число батчей калибровки")
+    parser.add_argument("--batch-size", type=int, default=16, help="Размер батча")
+    parser.add_argument("--latency-iterations", type=int, default=20, help="Число замеров задержки")
+    parser.add_argument("--max-drop", type=float, default=1.0,
+                        help="Допустимое падение точности, процентных пунктов")
+    parser.add_argument("--skip-quantize", action="store_true", help="Только проверка уже сохраненной модели")
+    return parser.parse_args()
+
+
+def evaluate(models: dict, dataloader) -> tuple[dict, float]:
+    correct = {name: 0 for name in models}
+    agree = 0
+    total = 0
+    for images, labels in dataloader:
+        predictions = {name: model.predict(images).argmax(1) for name, model in models.items()}
+        for name, predicted in predictions.items():
+            correct[name] += (predicted == labels).sum().item()
+        agree += (predictions["fp32"] == predictions["int8"]).sum().item()
+        total += len(labels)
+    return {name: count / total for name, count in correct.items()}, agree / total
+
+
+# Задержка на одну вырезку в миллисекундах для батча заданного размера
+def latency(model, batch: torch.Tensor, iterations: int) -> float:
+    model.predict(batch)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        model.predict(batch)
+    return (time.perf_counter() - started) / iterations / len(batch) * 1000
+
+
+def main():
+    args = parse_args()
+    fp32 = Classifier(args.classifier, None, torch.device("cpu"))
+    # Преобразование соответствует размеру входа модели (у облегченных моделей он меньше 224)
+    transform = fp32.transform
+
+    if not args.skip_quantize:
+        calibration_loader = DataLoader(dataset.ImageFolder(args.calibration_dir, transform),
+                                        batch_size=args.batch_size, shuffle=True)
+        calibration_batches = (images for images, _ in itertools.islice(calibration_loader, args.calibration_batches))
+        print(f"Калибровка на {args.calibration_batches} батчах из {args.calibration_dir}")
+        quantized = quantize_classifier(fp32.model, calibration_batches)
+        save_quantized(quantized, args.classifier, fp32.input_size)
+        print(f"Квантованная модель сохранена: {quantized_path(args.classifier)}")
+
+    models = {
+        "fp32": fp32,
+        "int8": QuantizedClassifier(args.classifier, None),
+    }
+    test_loader = DataLoader(dataset.ImageFolder(args.test_dir, transform), batch_size=args.batch_size)
+
+    accuracy, agreement = evaluate(models, test_loader)
+    drop = (accuracy["fp32"] - accuracy["int8"]) * 100
+
+    images, _ = next(iter(test_loader))
+    print(f"Тестовая выборка: {len(test_loader.dataset)} изображений, потоков: {torch.get_num_threads()}")
+    for name, model in models.items():
+        size = os.path.getsize(model.model_path) / 2 ** 20
+        single = latency(model, images[:1], args.latency_iterations)
+        batched = latency(model, images, args.latency_iterations)
+        print(f"{name.upper()}: точность {accuracy[name] * 100:.2f}% | {size:.1f} МБ | "
+              f"{single:.2f} мс/вырезка (батч 1), {batched:.2f} мс/вырезка (батч {len(images)})")
+    print(f"Падение точности: {drop:.2f} п.п. | Совпадение классов: {agreement * 100:.2f}%")
+
+    if drop > args.max_drop:
+        print(f"Падение точности больше допустимого ({args.max_drop:.2f} п.п.)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Фоновый журнал результатов: запись в JSONL с ротацией по размеру файла.
+# Обработчик запроса только кладет запись в очередь, сериализация и запись на диск
+# выполняются отдельным потоком пачками
+class ResultJournal:
+    def __init__(self, path: str, max_bytes: int, backup_count: int, flush_interval_ms: float, queue_size: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = max(flush_interval_ms, 1.0) / 1000
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.thread = None
+        self.file = None
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "ab")
+        self.thread = threading.Thread(target=self._run, name="result-journal", daemon=True)
+        self.thread.start()
+
+    # Постановка результата в очередь; при переполнении запись отбрасывается, запрос не ждет диск
+    def write(self, request_id: str, output) -> bool:
+        record = (request_id, datetime.now(timezone.utc).isoformat(), output)
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Очередь журнала результатов переполнена, отброшено записей: {self.dropped}")
+            return False
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+
+    def _run(self):
+        running = True
+        while running:
+            records = []
+            try:
+                records.append(self.queue.get(timeout=self.flush_interval))
+                while True:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in records:
+                running = False
+                records = [record for record in records if record is not None]
+            if not records:
+                continue
+
+            try:
+                with STAGE_SECONDS.time("write"):
+                    self._write_records(records)
+            except Exception:
+                logger.exception("Ошибка записи журнала результатов")
+
+    def _write_records(self, records: list):
+        lines = []
+        for request_id, timestamp, output in records:
+            lines.append(
+                f'{{"request_id": "{request_id}", "timestamp": "{timestamp}", '
+                f'"output": {output.model_dump_json()}}}\n'
+            )
+        data = "".join(lines).encode("utf-8")
+
+        if self.max_bytes > 0 and self.file.tell() > 0 and self.file.tell() + len(data) > self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    # Ротация как в logging.handlers.RotatingFileHandler: path -> path.1 -> ... -> path.N
+    def _rotate(self):
+        self.file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab")
@@ -1,18 +1,35 @@
 import numpy as np
 import io
+import asyncio
+import hashlib
 import json
 import logging
+import threading
+import os
+import shutil
+import signal
+import socket
+import gc
+import uuid
 import uvicorn
 import time
-from fastapi import FastAPI, File, UploadFile, status
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, File, Form, UploadFile, Query, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from PIL import Image
 from datacontract.service_config import ServiceConfig
 from datacontract.service_output import *
-from ultralytics import YOLO
+from datacontract.job_status import JobStatus
+from detector import preprocess_frames, restore_boxes, fit_frame, class_ids, load_detector
+from classifier import frame_to_tensor, crop_batch, crop_sizes, load_classifier
+from result_journal import ResultJournal
+from jobs import JobManager
+from tracking import KeyframeTracker
+from motion_gate import MotionGate, crop
+from metrics import STAGE_SECONDS, REQUEST_SECONDS, BATCH_SIZE, OBJECTS_PER_FRAME, QUEUE_DEPTH, expose, paused
 import torch
-from torchvision import transforms
 import pydantic
 from ultralytics.utils.plotting import Annotator, colors
 
@@ -41,36 +58,146 @@ class_names = {
     5: "Priority sings",
     6: "Warning sings"
 }
+class_indices = {name: idx for idx, name in class_names.items()}
 
 # Определение устройства
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Загрузка классификатора
-classifier = torch.load(r'resnet101_best_loss.pth', map_location=device)
-classifier.to(device)
-classifier.eval()
+# Модели загружаются функцией load_models при старте сервиса (или заранее, до запуска сервера);
+# до окончания загрузки и прогрева /ready отвечает 503, а запросы инференса отклоняются
+classifier = None
+transform = None
+classifier_crop_sizes = None
+detector_signs = None
+detector_cars = None
+detection_device = None
+detection_imgsz = None
+detection_stride = None
+car_classes = None
+model_version = None
+models_ready = threading.Event()
 
-# Преобразование изображений для классификатора
-transform = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-])
+# Предсказатели YOLO хранят состояние между вызовами, поэтому при нескольких
+# потоках инференса каждый детектор используется не более чем одним потоком сразу
+detector_signs_lock = threading.Lock()
+detector_cars_lock = threading.Lock()
 
-logger.info(f"Загружен классификатор: {service_config_python.path_to_classifier}")
+# Потоки для запуска детектора машин параллельно с детектором знаков
+detection_executor = ThreadPoolExecutor(
+    max_workers=max(1, service_config_python.inference_workers),
+    thread_name_prefix="detection"
+)
+
+# Загрузка классификатора и обоих детекторов параллельно (бэкенды задаются суффиксами
+# name_of_classifier и name_of_detector). Повторный вызов ничего не делает
+def load_models():
+    global classifier, transform, classifier_crop_sizes, detector_signs, detector_cars
+    global detection_device, detection_imgsz, detection_stride, car_classes, model_version
+    if classifier is not None:
+        return
+
+    logger.info("Загрузка моделей")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="load") as executor:
+        classifier_future = executor.submit(
+            load_classifier,
+            service_config_python.name_of_classifier,
+            service_config_python.path_to_classifier,
+            class_names,
+            device
+        )
+        signs_future = executor.submit(
+            load_detector, service_config_python.name_of_detector, service_config_python.path_to_detector
+        )
+        cars_future = executor.submit(
+            load_detector, service_config_python.name_of_detector, service_config_python.path_to_car_detector
+        )
+        loaded_classifier = classifier_future.result()
+        detector_signs = signs_future.result()
+        detector_cars = cars_future.result()
+
+    # Преобразование изображений для классификатора; размер вырезки задает модель (input_size)
+    transform = loaded_classifier.transform
+    classifier_crop_sizes = crop_sizes(loaded_classifier.input_size)
+    logger.info(f"Загружен классификатор: {loaded_classifier.model_path} "
+                f"({loaded_classifier.backend}, вход {loaded_classifier.input_size})")
+    logger.info(f"Модели YOLO загружены: {detector_signs.model_path}, {detector_cars.model_path} "
+                f"({detector_signs.backend})")
+
+    # Экспортированные детекторы работают на CPU, туда же сразу кладется тензор кадров
+    detection_device = device if detector_signs.backend == "torch" else torch.device("cpu")
+    # Общий размер входа детекторов: кадр приводится к нему один раз для обеих моделей.
+    # Размер из конфигурации округляется вверх до шага сетки: ultralytics не принимает тензор,
+    # стороны которого не кратны stride
+    detection_stride = max(detector_signs.stride, detector_cars.stride)
+    detection_imgsz = int(np.ceil(
+        (service_config_python.detection_imgsz or detector_signs.imgsz) / detection_stride
+    ) * detection_stride)
+    # Детектор машин выполняет NMS только по классу "car" из COCO
+    car_classes = class_ids(detector_cars, {"car"})
+    logger.info(f"Размер входа детекторов: {detection_imgsz}, классы машин: {car_classes}")
+
+    model_version = compute_model_version(
+        [loaded_classifier.model_path, detector_signs.model_path, detector_cars.model_path]
+    )
+    # Классификатор присваивается последним: по нему проверяется, что загрузка завершена
+    classifier = loaded_classifier
+    logger.info(f"Модели загружены за {time.perf_counter() - started:.2f} с")
+
+# Прогрев: первые вызовы моделей выделяют память и выбирают алгоритмы свертки, поэтому
+# до приема запросов через полный конвейер проходят батчи из 1 и max_batch_size кадров
+# целевого размера, а через классификатор - батчи вырезок
+def warmup_models():
+    started = time.perf_counter()
+    generator = np.random.default_rng(0)
+    frame_shape = (service_config_python.target_height, service_config_python.target_width, 3)
+    input_size = classifier.input_size
+    with paused():
+        for batch_size in sorted({1, max(1, service_config_python.max_batch_size)}):
+            frames = [generator.integers(0, 256, frame_shape, dtype=np.uint8) for _ in range(batch_size)]
+            crops = torch.zeros(batch_size, 3, input_size, input_size, device=classifier.device)
+            for _ in range(service_config_python.warmup_batches):
+                process_batch(frames)
+                classifier.predict(crops)
+    logger.info(f"Прогрев моделей: {service_config_python.warmup_batches} батчей, "
+                f"{time.perf_counter() - started:.2f} с")
+
+# Подготовка детекторов PyTorch в главном процессе до fork: ultralytics создает predictor при первом
+# вызове predict и тогда же заменяет слои Conv+BN объединенными весами, поэтому без этого каждый процесс
+# держал бы свою копию весов. Пул detection_executor здесь не используется: потоки, запущенные до fork,
+# в дочерних процессах отсутствуют
+def setup_detectors():
+    frame = np.zeros((detection_imgsz, detection_imgsz, 3), dtype=np.uint8)
+    frames_tensor = preprocess_frames([frame], detection_imgsz, detection_device, stride=detection_stride)
+    for detector in (detector_signs, detector_cars):
+        if detector.backend == "torch":
+            detector.predict(frames_tensor, conf=0.5)
 
-# Загрузка моделей YOLO
-logger.info("Загрузка моделей YOLO")
-detector_signs = YOLO(r"best.pt")
-detector_cars = YOLO(r"yolov8s.pt")
-logger.info("Модели загружены")
+# Детекция машин на общем предобработанном тензоре
+def detect_cars(frames_tensor: torch.Tensor) -> list[torch.Tensor]:
+    with detector_cars_lock, STAGE_SECONDS.time("car_detection"):
+        return detector_cars.predict(frames_tensor, conf=0.5, classes=car_classes)
 
 # Функция классификации
 def classify_batch(images: list[Image.Image]) -> list[str]:
-    tensor_batch = torch.stack([transform(img) for img in images]).to(device)
-    with torch.no_grad():
-        outputs = classifier(tensor_batch)
+    with STAGE_SECONDS.time("crop"):
+        tensor_batch = torch.stack([transform(img) for img in images]).to(classifier.device)
+    with STAGE_SECONDS.time("classification"):
+        outputs = classifier.predict(tensor_batch)
+    _, predicted_indices = torch.max(outputs, 1)
+    return [class_names[idx.item()] for idx in predicted_indices]
+
+# Классификация знаков по рамкам: кадр переводится в нормализованный тензор один раз,
+# все рамки кадра вырезаются и масштабируются одной операцией ROI Align
+def classify_regions(images: list[np.ndarray], boxes_per_image: list[np.ndarray], bgr_flags: list[bool]) -> list[str]:
+    with STAGE_SECONDS.time("crop"):
+        tensor_batch = torch.cat([
+            crop_batch(frame_to_tensor(image, classifier.device, bgr), boxes, *classifier_crop_sizes)
+            for image, boxes, bgr in zip(images, boxes_per_image, bgr_flags)
+            if len(boxes) > 0
+        ])
+    with STAGE_SECONDS.time("classification"):
+        outputs = classifier.predict(tensor_batch)
     _, predicted_indices = torch.max(outputs, 1)
     return [class_names[idx.item()] for idx in predicted_indices]
 
@@ -85,42 +212,114 @@ def classify_batch(images: list[Image.Image]) -> list[str]:
 def health_check() -> str:
     return '{"Status" : "OK"}'
 
-# Основной маршрут обработки изображения
-@app.post("/file")
-async def inference(image: UploadFile = File(...)) -> JSONResponse:
-    start_time_ns = time.perf_counter_ns()
+# Готовность к приему запросов: модели загружены и прогреты. В отличие от /health,
+# отвечает 503, пока идет загрузка, чтобы балансировщик не направлял запросы на новый экземпляр
+@app.get(
+    "/ready",
+    tags=["healthcheck"],
+    summary="Готовность сервиса к инференсу",
+    response_description="HTTP статус 200 после загрузки и прогрева моделей, иначе 503",
+    status_code=status.HTTP_200_OK,
+)
+def readiness_check() -> Response:
+    if not models_ready.is_set():
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"Status": "Loading"})
+    return JSONResponse(content={"Status": "OK"})
 
-    # Чтение изображения
-    image_content = await image.read()
-    pil_image = Image.open(io.BytesIO(image_content))
-    if pil_image.mode != 'RGB':
-        pil_image = pil_image.convert('RGB')
+# Ответ на запрос инференса, пришедший до готовности моделей
+def not_ready_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Модели загружаются"}
+    )
 
-    cv_image = np.array(pil_image)
-    logger.info(f"Принята картинка размерности: {cv_image.shape}")
+# Версия моделей: меняется при смене файлов весов или параметров, влияющих на результат.
+# Клиенты используют ее как часть ключа кэша результатов детекции
+def compute_model_version(model_paths: list[str]) -> str:
+    version = hashlib.sha1()
+    for path in model_paths:
+        stat = os.stat(path)
+        version.update(f"{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)};".encode())
+    # Кадры уменьшаются до рабочего разрешения до детекции, поэтому оно тоже влияет на рамки
+    version.update(f"{detection_imgsz};{service_config_python.crop_pipeline};"
+                   f"{service_config_python.target_width}x{service_config_python.target_height}".encode())
+    return version.hexdigest()[:16]
 
-    output_dict = {"objects": []}
-    annotator = Annotator(cv_image.copy(), line_width=2)
+@app.get(
+    "/version",
+    tags=["healthcheck"],
+    summary="Версия моделей сервиса",
+    response_description="Названия моделей и хэш версии весов",
+    status_code=status.HTTP_200_OK,
+)
+def get_version() -> dict:
+    return {
+        "classifier": service_config_python.name_of_classifier,
+        "detector": service_config_python.name_of_detector,
+        "model_version": model_version,
+    }
+
+# Обработка батча изображений: один проход детекторов и классификатора на весь батч.
+# bgr_flags задает порядок каналов каждого изображения (по умолчанию RGB), target_sizes - рабочее
+# разрешение (ширина, высота) каждого изображения (по умолчанию target_width x target_height)
+def process_batch(frames: list[np.ndarray], bgr_flags: Optional[list[bool]] = None,
+                  target_sizes: Optional[list[Optional[tuple[int, int]]]] = None) -> list[ServiceOutput]:
+    objects = [[] for _ in frames]
+    bgr_flags = bgr_flags or [False] * len(frames)
+    target_sizes = target_sizes or [None] * len(frames)
+
+    with STAGE_SECONDS.time("preprocess"):
+        # Большие кадры уменьшаются до рабочего разрешения: детекция и вырезка знаков выполняются
+        # на уменьшенном кадре, рамки переводятся обратно в координаты исходного кадра
+        images = []
+        box_scales = []
+        for frame, target_size in zip(frames, target_sizes):
+            image, (scale_x, scale_y) = fit_frame(
+                frame, *(target_size or (service_config_python.target_width, service_config_python.target_height))
+            )
+            images.append(image)
+            box_scales.append(np.array([scale_x, scale_y, scale_x, scale_y]))
+
+        # Общая предобработка кадров для обоих детекторов
+        frames_tensor = preprocess_frames(images, detection_imgsz, detection_device, bgr_flags, detection_stride)
+        tensor_shape = frames_tensor.shape[2:]
+
+    # Детекция машин выполняется параллельно с детекцией знаков
+    cars_future = detection_executor.submit(detect_cars, frames_tensor)
 
     # Детекция знаков
-    results_signs = detector_signs.predict(cv_image, conf=0.5, verbose=False)
-    boxes_signs = results_signs[0].boxes.xyxy
-    clss_signs = results_signs[0].boxes.cls
+    with detector_signs_lock, STAGE_SECONDS.time("sign_detection"):
+        results_signs = detector_signs.predict(frames_tensor, conf=0.5)
+
+    boxes_per_image = []
+    crop_owners = []
+    for image_idx, (image, result) in enumerate(zip(images, results_signs)):
+        boxes_signs = result[:, :4]
 
-    if boxes_signs is not None and boxes_signs.shape[0] > 0:
-        boxes_signs = boxes_signs.cpu().numpy()
-        clss_signs = clss_signs.cpu().numpy()
+        if boxes_signs.shape[0] == 0:
+            boxes_per_image.append(np.empty((0, 4)))
+            continue
 
-        crop_images = [
-            Image.fromarray(cv_image[int(box[1]):int(box[3]), int(box[0]):int(box[2])])
-            for box in boxes_signs
-        ]
+        boxes_signs = restore_boxes(boxes_signs, tensor_shape, image.shape)
+        boxes_per_image.append(boxes_signs)
 
-        class_names_list = classify_batch(crop_images)
+        for i, box in enumerate(boxes_signs):
+            crop_owners.append((image_idx, i, box))
 
-        for i, (box, cls, class_name) in enumerate(zip(boxes_signs, clss_signs, class_names_list)):
-            annotator.box_label(box, color=colors(int(cls), True), label=class_name)
-            output_dict["objects"].append(
+    # Классификация всех знаков батча одним вызовом
+    if crop_owners:
+        if service_config_python.crop_pipeline == "pil":
+            class_names_list = classify_batch([
+                Image.fromarray(crop[..., ::-1] if bgr_flags[image_idx] else crop)
+                for image_idx, _, box in crop_owners
+                for crop in [images[image_idx][int(box[1]):int(box[3]), int(box[0]):int(box[2])]]
+            ])
+        else:
+            class_names_list = classify_regions(images, boxes_per_image, bgr_flags)
+
+        for (image_idx, i, box), class_name in zip(crop_owners, class_names_list):
+            box = box * box_scales[image_idx]
+            objects[image_idx].append(
                 DetectedObject(
                     xtl=int(box[0]), ytl=int(box[1]),
                     xbr=int(box[2]), ybr=int(box[3]),
@@ -130,45 +329,642 @@ async def inference(image: UploadFile = File(...)) -> JSONResponse:
             )
 
     # Детекция машин
-    results_cars = detector_cars.predict(cv_image, conf=0.5, verbose=False)
-    boxes_cars = results_cars[0].boxes.xyxy
-    clss_cars = results_cars[0].boxes.cls
-    names_coco = results_cars[0].names
-
-    if boxes_cars is not None and boxes_cars.shape[0] > 0:
-        boxes_cars = boxes_cars.cpu().numpy()
-        clss_cars = clss_cars.cpu().numpy()
-
-        for i, (box, cls) in enumerate(zip(boxes_cars, clss_cars)):
-            class_name = names_coco[int(cls)]
-            if class_name.lower() == "car":
-                annotator.box_label(box, color=(0, 255, 0), label=class_name)
-                output_dict["objects"].append(
-                    DetectedObject(
-                        xtl=int(box[0]), ytl=int(box[1]),
-                        xbr=int(box[2]), ybr=int(box[3]),
-                        class_name="Car",
-                        tracked_id=1000 + i
-                    )
+    results_cars = cars_future.result()
+
+    for image_idx, (image, result) in enumerate(zip(images, results_cars)):
+        boxes_cars = result[:, :4]
+
+        if boxes_cars.shape[0] == 0:
+            continue
+
+        boxes_cars = restore_boxes(boxes_cars, tensor_shape, image.shape) * box_scales[image_idx]
+
+        for i, box in enumerate(boxes_cars):
+            objects[image_idx].append(
+                DetectedObject(
+                    xtl=int(box[0]), ytl=int(box[1]),
+                    xbr=int(box[2]), ybr=int(box[3]),
+                    class_name="Car",
+                    tracked_id=1000 + i
                 )
+            )
+
+    # Размеры в ответе - размеры исходного кадра, в координатах которого заданы рамки
+    for image_objects in objects:
+        OBJECTS_PER_FRAME.observe(len(image_objects))
+    return [
+        ServiceOutput(width=frame.shape[1], height=frame.shape[0], channels=frame.shape[2], objects=image_objects)
+        for frame, image_objects in zip(frames, objects)
+    ]
+
+# Отрисовка найденных объектов на копии кадра и кодирование в JPEG (только по запросу)
+def render_annotated(image: np.ndarray, service_output: ServiceOutput, bgr: bool = False) -> bytes:
+    annotator = Annotator(image.copy(), line_width=2)
+    for obj in service_output.objects:
+        box = [obj.xtl, obj.ytl, obj.xbr, obj.ybr]
+        if obj.class_name == "Car":
+            color = (0, 255, 0)
+        else:
+            color = colors(class_indices.get(obj.class_name, 0), True)
+        annotator.box_label(box, color=color, label=obj.class_name)
+
+    buffer = io.BytesIO()
+    annotated = annotator.result()
+    Image.fromarray(annotated[..., ::-1] if bgr else annotated).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+# Планировщик динамического батчинга: собирает изображения из параллельных запросов
+# в окне max_batch_wait_ms (не более max_batch_size штук) и передает батчи в пул потоков
+# инференса, чтобы синхронные вызовы моделей не блокировали цикл событий
+class BatchScheduler:
+    def __init__(self, max_batch_size: int, max_batch_wait_ms: float, workers: int, queue_size: int):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_wait = max(0.0, max_batch_wait_ms) / 1000
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self.workers_available = asyncio.Semaphore(self.workers)
+        self.batches_in_flight = 0
+        self.tasks = set()
+
+    # Постановка изображения в очередь; при переполнении очереди выбрасывает asyncio.QueueFull.
+    # target_size (ширина, высота) переопределяет рабочее разрешение из конфигурации
+    async def submit(self, image: np.ndarray, bgr: bool = False,
+                     target_size: Optional[tuple[int, int]] = None) -> ServiceOutput:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((image, bgr, target_size, time.perf_counter(), future))
+        QUEUE_DEPTH.inc()
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "batches_in_flight": self.batches_in_flight,
+            "queue_size": self.queue_size,
+            "queue_depth": self.queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "max_batch_wait_ms": self.max_batch_wait * 1000,
+        }
+
+    async def collect_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_batch_wait
+
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                getter.cancel()
+                break
+            batch.append(getter.result())
+
+        return batch
+
+    async def run_batch(self, batch: list):
+        images = [image for image, *_ in batch]
+        bgr_flags = [bgr for _, bgr, *_ in batch]
+        target_sizes = [target_size for _, _, target_size, *_ in batch]
+        # Время ожидания каждого изображения в очереди до начала обработки батча
+        started = time.perf_counter()
+        for _, _, _, enqueued, _ in batch:
+            STAGE_SECONDS.observe(started - enqueued, "queue")
+        QUEUE_DEPTH.dec(len(batch))
+        BATCH_SIZE.observe(len(batch))
+        self.batches_in_flight += 1
+        logger.info(f"Сформирован батч из {len(images)} изображений, в очереди: {self.queue.qsize()}")
+
+        try:
+            outputs = await asyncio.get_running_loop().run_in_executor(
+                self.executor, process_batch, images, bgr_flags, target_sizes
+            )
+        except Exception as e:
+            logger.exception("Ошибка при обработке батча")
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.batches_in_flight -= 1
+            self.workers_available.release()
+
+        for (*_, future), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(output)
+
+    async def run(self):
+        while True:
+            # Батч набирается только при наличии свободного потока, пока потоки заняты
+            # запросы копятся в очереди и попадают в следующий, более крупный батч
+            await self.workers_available.acquire()
+            batch = await self.collect_batch()
+            task = asyncio.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        detection_executor.shutdown(wait=False, cancel_futures=True)
+
+batch_scheduler = BatchScheduler(
+    service_config_python.max_batch_size,
+    service_config_python.max_batch_wait_ms,
+    service_config_python.inference_workers,
+    service_config_python.inference_queue_size
+)
+logger.info(f"Пул инференса: потоков {batch_scheduler.workers}, размер очереди {batch_scheduler.queue_size}")
+
+# Фоновый журнал результатов (включается параметром journal_path)
+result_journal = None
+if service_config_python.journal_path:
+    result_journal = ResultJournal(
+        service_config_python.journal_path,
+        service_config_python.journal_max_bytes,
+        service_config_python.journal_backup_count,
+        service_config_python.journal_flush_interval_ms,
+        service_config_python.journal_queue_size
+    )
+
+# Трекер для видеопотока в режиме трекинга (отдельный на каждый поток кадров)
+def make_tracker(bgr: bool = False) -> KeyframeTracker:
+    return KeyframeTracker(
+        keyframe_interval=service_config_python.tracking_keyframe_interval,
+        min_confidence=service_config_python.tracking_min_confidence,
+        distance_threshold=service_config_python.tracking_distance_threshold,
+        bgr=bgr
+    )
+
+# Фильтр статичных кадров для видеопотока (отдельный на каждый поток кадров)
+def make_motion_gate(bgr: bool = False) -> MotionGate:
+    return MotionGate(
+        threshold=service_config_python.motion_gate_threshold,
+        min_changed=service_config_python.motion_gate_min_changed,
+        grid=service_config_python.motion_gate_grid,
+        max_region=service_config_python.motion_gate_max_region,
+        bgr=bgr
+    )
 
+# Задачи обработки видео выполняются в том же пуле инференса, что и запросы /file;
+# кадры OpenCV передаются в порядке BGR без преобразования
+job_manager = JobManager(
+    service_config_python.jobs_dir,
+    lambda frames: batch_scheduler.executor.submit(process_batch, frames, [True] * len(frames)).result(),
+    service_config_python.job_batch_size,
+    service_config_python.job_checkpoint_every,
+    lambda: make_tracker(bgr=True),
+    lambda: make_motion_gate(bgr=True)
+)
+
+# Загрузка и прогрев моделей в фоне: сервер сразу отвечает на /health, а планировщик батчей
+# и задачи обработки видео запускаются после прогрева. При ошибке загрузки сервис завершается
+async def prepare_models():
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, load_models)
+        await loop.run_in_executor(batch_scheduler.executor, warmup_models)
+    except Exception:
+        logger.exception("Ошибка загрузки моделей")
+        os.kill(os.getpid(), signal.SIGTERM)
+        return
+    app.state.batch_scheduler_task = asyncio.create_task(batch_scheduler.run())
+    job_manager.start()
+    models_ready.set()
+    logger.info("Сервис готов к приему запросов")
+
+@app.on_event("startup")
+async def start_batch_scheduler():
+    app.state.batch_scheduler_task = None
+    app.state.prepare_models_task = asyncio.create_task(prepare_models())
+    if result_journal is not None:
+        result_journal.start()
+        logger.info(f"Журнал результатов: {result_journal.path}")
+
+@app.on_event("shutdown")
+async def stop_batch_scheduler():
+    app.state.prepare_models_task.cancel()
+    job_manager.stop()
+    if app.state.batch_scheduler_task is not None:
+        app.state.batch_scheduler_task.cancel()
+    batch_scheduler.shutdown()
+    if result_journal is not None:
+        result_journal.close()
+
+# Состояние очереди и пула инференса
+@app.get(
+    "/queue",
+    tags=["healthcheck"],
+    summary="Состояние очереди инференса",
+    response_description="Число потоков, глубина очереди и число обрабатываемых батчей",
+    status_code=status.HTTP_200_OK,
+)
+def queue_stats() -> dict:
+    return batch_scheduler.stats()
+
+# Метрики производительности в текстовом формате Prometheus: длительность этапов обработки,
+# размеры батчей, глубина очереди и число объектов на кадре (суммарно по всем процессам сервиса)
+@app.get(
+    "/metrics",
+    tags=["healthcheck"],
+    summary="Метрики производительности (Prometheus)",
+    response_description="Гистограммы длительности этапов, размеров батчей и числа объектов на кадре",
+    status_code=status.HTTP_200_OK,
+)
+def get_metrics() -> Response:
+    return Response(content=expose(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Рабочее разрешение запроса: недостающая сторона берется из конфигурации
+def target_size(width: Optional[int], height: Optional[int]) -> Optional[tuple[int, int]]:
+    if width is None and height is None:
+        return None
+    return width or service_config_python.target_width, height or service_config_python.target_height
+
+# Декодирование загруженного изображения в RGB-массив
+def decode_image(image_content: bytes) -> np.ndarray:
+    with STAGE_SECONDS.time("decode"):
+        pil_image = Image.open(io.BytesIO(image_content))
+        if pil_image.mode != 'RGB':
+            pil_image = pil_image.convert('RGB')
+        return np.array(pil_image)
+
+# Основной маршрут обработки изображения
+@app.post("/file")
+async def inference(
+    image: UploadFile = File(...),
+    render: Optional[str] = Query(default=None, description='"jpeg" - вернуть изображение с отрисованными объектами'),
+    target_width: Optional[int] = Query(default=None, gt=0, description="Рабочая ширина вместо target_width"),
+    target_height: Optional[int] = Query(default=None, gt=0, description="Рабочая высота вместо target_height")
+) -> Response:
+    start_time_ns = time.perf_counter_ns()
+    request_id = uuid.uuid4().hex
+
+    if render not in (None, "jpeg"):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": f"Неподдерживаемый режим отрисовки: {render}"}
+        )
+
+    # Чтение изображения
+    with STAGE_SECONDS.time("read"):
+        image_content = await image.read()
+    cv_image = decode_image(image_content)
+    logger.info(f"Принята картинка размерности: {cv_image.shape}")
+
+    return await infer_and_respond(cv_image, False, render, start_time_ns, request_id,
+                                   target_size(target_width, target_height))
+
+# Прием кадра без сжатия: тело запроса содержит пиксели uint8 в порядке строк,
+# форма задается заголовком X-Frame-Shape ("высота,ширина,3"), тип - X-Frame-Dtype,
+# порядок каналов - X-Frame-Channels ("BGR" по умолчанию, как у OpenCV, или "RGB").
+# Буфер оборачивается в массив numpy без копирования и сразу передается детекторам
+@app.post("/raw")
+async def raw_inference(
+    request: Request,
+    render: Optional[str] = Query(default=None, description='"jpeg" - вернуть изображение с отрисованными объектами'),
+    target_width: Optional[int] = Query(default=None, gt=0, description="Рабочая ширина вместо target_width"),
+    target_height: Optional[int] = Query(default=None, gt=0, description="Рабочая высота вместо target_height")
+) -> Response:
+    start_time_ns = time.perf_counter_ns()
+    request_id = uuid.uuid4().hex
+
+    if render not in (None, "jpeg"):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": f"Неподдерживаемый режим отрисовки: {render}"}
+        )
+
+    try:
+        shape = tuple(int(dim) for dim in request.headers["X-Frame-Shape"].split(","))
+    except (KeyError, ValueError):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": "Заголовок X-Frame-Shape должен иметь вид высота,ширина,3"}
+        )
+    dtype = request.headers.get("X-Frame-Dtype", "uint8").lower()
+    channels = request.headers.get("X-Frame-Channels", "BGR").upper()
+
+    if len(shape) != 3 or shape[2] != 3 or min(shape) <= 0:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": f"Неподдерживаемая форма кадра: {shape}"}
+        )
+    if dtype != "uint8" or channels not in ("BGR", "RGB"):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": f"Неподдерживаемый формат кадра: {dtype} {channels}"}
+        )
 
-    # Формирование JSON
-    service_output = ServiceOutput(objects=output_dict["objects"])
-    service_output_json = service_output.model_dump(mode="json")
+    with STAGE_SECONDS.time("read"):
+        image_content = await request.body()
+    if len(image_content) != shape[0] * shape[1] * shape[2]:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": f"Размер тела {len(image_content)} не соответствует форме кадра {shape}"}
+        )
 
-    # Сохранение JSON в файл
-    with open("output_json.json", "w") as output_file:
-        json.dump(service_output_json, output_file, indent=4)
+    with STAGE_SECONDS.time("decode"):
+        cv_image = np.frombuffer(image_content, dtype=np.uint8).reshape(shape)
+    logger.info(f"Принят кадр без сжатия размерности: {cv_image.shape} ({channels})")
+
+    return await infer_and_respond(cv_image, channels == "BGR", render, start_time_ns, request_id,
+                                   target_size(target_width, target_height))
+
+# Инференс принятого кадра и формирование ответа (JSON или JPEG с отрисовкой)
+async def infer_and_respond(cv_image: np.ndarray, bgr: bool, render: Optional[str],
+                            start_time_ns: int, request_id: str,
+                            target_size: Optional[tuple[int, int]] = None) -> Response:
+    if not models_ready.is_set():
+        return not_ready_response()
+
+    # Детекция и классификация в общем батче с параллельными запросами
+    try:
+        service_output = await batch_scheduler.submit(cv_image, bgr, target_size)
+    except asyncio.QueueFull:
+        logger.warning("Очередь инференса переполнена, запрос отклонен")
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"detail": "Очередь инференса переполнена"}
+        )
+
+    # Запись результата в журнал выполняется в фоне
+    if result_journal is not None:
+        result_journal.write(request_id, service_output)
+
+    # Отрисовка выполняется только для запросов с render=jpeg
+    if render == "jpeg":
+        with STAGE_SECONDS.time("render"):
+            jpeg_bytes = await asyncio.get_running_loop().run_in_executor(
+                None, render_annotated, cv_image, service_output, bgr
+            )
 
     elapsed_us = (time.perf_counter_ns() - start_time_ns) / 1000  # время в микросекундах
-    logger.info(f"Обнаружено объектов: {len(output_dict['objects'])}")
+    logger.info(f"Обнаружено объектов: {len(service_output.objects)}")
     logger.info(f"Время обработки: {elapsed_us:.2f} мкс")
 
-    response = JSONResponse(content=jsonable_encoder(service_output_json))
+    if render == "jpeg":
+        response = Response(content=jpeg_bytes, media_type="image/jpeg")
+        response.headers["X-Objects-Count"] = str(len(service_output.objects))
+    else:
+        # Формирование JSON
+        with STAGE_SECONDS.time("serialization"):
+            service_output_json = service_output.model_dump(mode="json")
+            response = JSONResponse(content=jsonable_encoder(service_output_json))
     response.headers["X-Process-Time-us"] = f"{elapsed_us:.2f}"
+    response.headers["X-Request-Id"] = request_id
+    REQUEST_SECONDS.observe((time.perf_counter_ns() - start_time_ns) / 1e9)
     return response
 
+# Потоковая обработка кадров по WebSocket: клиент отправляет кадры (JPEG/PNG) бинарными
+# сообщениями и получает ServiceOutput в том же порядке. Одновременно в обработке может
+# находиться до ws_max_in_flight кадров соединения, при заполнении чтение из сокета приостанавливается
+@app.websocket("/ws")
+async def stream_inference(
+    websocket: WebSocket,
+    tracking: bool = Query(default=False, description="Полный инференс только на ключевых кадрах, между ними - трекинг"),
+    motion_gate: bool = Query(default=False, description="Повторное использование результата для статичных кадров"),
+    target_width: Optional[int] = Query(default=None, gt=0, description="Рабочая ширина вместо target_width"),
+    target_height: Optional[int] = Query(default=None, gt=0, description="Рабочая высота вместо target_height")
+):
+    await websocket.accept()
+    if not models_ready.is_set():
+        await websocket.close(code=1013, reason="Модели загружаются")
+        return
+    # Место в обработке занимается до создания задачи кадра и освобождается после получения его результата,
+    # поэтому одновременно обрабатывается не больше ws_max_in_flight кадров соединения
+    in_flight = asyncio.Semaphore(max(1, service_config_python.ws_max_in_flight))
+    pending: asyncio.Queue = asyncio.Queue()
+    tracker = make_tracker() if tracking else None
+    gate = make_motion_gate() if motion_gate else None
+    stream_lock = asyncio.Lock()
+    stream_target_size = target_size(target_width, target_height)
+    logger.info(f"Открыто потоковое соединение{' с трекингом' if tracking else ''}"
+                f"{' с пропуском статичных кадров' if motion_gate else ''}")
+
+    # Инференс кадра или только его изменившейся части
+    async def detect(image: np.ndarray) -> ServiceOutput:
+        if gate is None:
+            return await batch_scheduler.submit(image, target_size=stream_target_size)
+        region = await asyncio.get_running_loop().run_in_executor(None, gate.check, image)
+        if region is None:
+            return gate.output
+        output = await batch_scheduler.submit(crop(image, region), target_size=stream_target_size)
+        return gate.update(image, region, output)
+
+    async def infer_frame(image_content: bytes) -> ServiceOutput:
+        image = decode_image(image_content)
+        if tracker is None and gate is None:
+            return await batch_scheduler.submit(image, target_size=stream_target_size)
+
+        # Состояние трекера и фильтра зависит от предыдущих кадров, поэтому кадры обрабатываются
+        # строго по порядку; блокировка выдается в порядке поступления кадров
+        async with stream_lock:
+            if tracker is None:
+                return await detect(image)
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(None, tracker.propagate, image)
+            if output is None:
+                output = await loop.run_in_executor(None, tracker.keyframe, image, await detect(image))
+            return output
+
+    async def receive_frames():
+        try:
+            while True:
+                image_content = await websocket.receive_bytes()
+                await in_flight.acquire()
+                pending.put_nowait(asyncio.create_task(infer_frame(image_content)))
+        except WebSocketDisconnect:
+            pass
+        except Exception:
+            logger.exception("Ошибка чтения кадра из потока")
+        pending.put_nowait(None)
+
+    receiver = asyncio.create_task(receive_frames())
+    try:
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            try:
+                output = await task
+                with STAGE_SECONDS.time("serialization"):
+                    message = output.model_dump_json()
+            except asyncio.QueueFull:
+                message = json.dumps({"detail": "Очередь инференса переполнена"}, ensure_ascii=False)
+            except Exception as e:
+                logger.exception("Ошибка при обработке кадра потока")
+                message = json.dumps({"detail": f"Ошибка обработки кадра: {e}"}, ensure_ascii=False)
+            finally:
+                in_flight.release()
+            await websocket.send_text(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+        if tracker is not None:
+            logger.info(f"Ключевых кадров в потоке: {tracker.keyframes} из {tracker.frames}")
+        if gate is not None:
+            logger.info(f"Кадров без инференса в потоке: {gate.reused} из {gate.frames}, частично {gate.partial}")
+        logger.info("Потоковое соединение закрыто")
+
+# Создание задачи обработки видео: путь к файлу на сервере или загрузка файла
+@app.post("/jobs", tags=["jobs"], summary="Создание задачи обработки видео")
+async def create_job(
+    video_path: Optional[str] = Form(default=None),
+    video: Optional[UploadFile] = File(default=None),
+    tracking: bool = Form(default=False),
+    motion_gate: bool = Form(default=False)
+) -> JSONResponse:
+    # Задачи, созданные до запуска менеджера задач, были бы поставлены в очередь дважды
+    if not models_ready.is_set():
+        return not_ready_response()
+
+    if video is None and not video_path:
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"detail": "Нужно указать video_path или загрузить video"}
+        )
+
+    if video is not None:
+        # Загруженное видео сохраняется в каталог задачи частями, без чтения целиком в память
+        job_id = uuid.uuid4().hex
+        job_dir = job_manager.job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        extension = os.path.splitext(video.filename or "")[1] or ".mp4"
+        video_path = os.path.join(job_dir, "video" + extension)
+        with open(video_path, "wb") as video_file:
+            await asyncio.get_running_loop().run_in_executor(None, shutil.copyfileobj, video.file, video_file)
+        job = job_manager.submit(video_path, job_id, tracking, motion_gate)
+    elif not os.path.isfile(video_path):
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content={"detail": f"Видео не найдено: {video_path}"}
+        )
+    else:
+        job = job_manager.submit(video_path, tracking=tracking, motion_gate=motion_gate)
+
+    logger.info(f"Создана задача {job.job_id}: {job.video_path}")
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.model_dump(mode="json"))
+
+@app.get("/jobs", tags=["jobs"], summary="Список задач обработки видео")
+def list_jobs() -> list[JobStatus]:
+    return job_manager.list()
+
+@app.get("/jobs/{job_id}", tags=["jobs"], summary="Прогресс задачи обработки видео")
+def get_job(job_id: str) -> JobStatus:
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": "Задача не найдена"})
+    return job
+
+@app.post("/jobs/{job_id}/resume", tags=["jobs"], summary="Повторный запуск задачи с контрольной точки")
+def resume_job(job_id: str) -> JobStatus:
+    job = job_manager.resume(job_id)
+    if job is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": "Задача не найдена"})
+    return job
+
+# Покадровые результаты задачи (JSONL, строка на кадр); доступны и во время обработки
+@app.get("/jobs/{job_id}/results", tags=["jobs"], summary="Результаты задачи обработки видео")
+def get_job_results(job_id: str):
+    results_path = job_manager.results_path(job_id)
+    if job_manager.get(job_id) is None or not os.path.exists(results_path):
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": "Задача не найдена"})
+    return FileResponse(results_path, media_type="application/x-ndjson")
+
+# Настройка процесса сервиса при нескольких процессах: каждый процесс пишет журнал результатов
+# в свой файл (output_journal.worker<номер>.jsonl) со своей ротацией, а задачи обработки видео
+# выполняет только процесс 0; остальные принимают задачи и читают их состояние из jobs_dir
+def configure_worker(worker_idx: int):
+    if result_journal is not None:
+        root, extension = os.path.splitext(service_config_python.journal_path)
+        result_journal.path = f"{root}.worker{worker_idx}{extension}"
+    job_manager.runner = worker_idx == 0
+
+# Запуск сервиса. При workers > 1 модели загружаются один раз в главном процессе, затем через fork
+# создаются workers процессов, которые принимают соединения с общего сокета. Веса моделей остаются
+# общими страницами памяти (copy-on-write), а потоки intra-op PyTorch делятся между процессами.
+# Без fork или на GPU (контекст CUDA не переживает fork) сервис работает одним процессом
+def serve(host: str, port: int, workers: int):
+    threads = service_config_python.threads_per_worker or max(1, (os.cpu_count() or 1) // max(1, workers))
+    if workers <= 1 or not hasattr(os, "fork") or device.type == "cuda":
+        if workers > 1:
+            logger.warning("Несколько процессов недоступны (нет fork или используется GPU), запуск одного процесса")
+        if service_config_python.threads_per_worker:
+            torch.set_num_threads(threads)
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    # Главный процесс не выполняет вычислений в несколько потоков: пул потоков OpenMP,
+    # созданный до fork, в дочерних процессах не работает
+    torch.set_num_threads(1)
+    load_models()
+    setup_detectors()
+    # Загруженные объекты исключаются из сборки мусора: ее обход пишет в заголовки объектов
+    # и копировал бы общие страницы памяти в каждый процесс
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children = {}
+    for worker_idx in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Прогрев, планировщик батчей и журнал запускаются в каждом процессе при старте приложения
+            exit_code = 0
+            try:
+                configure_worker(worker_idx)
+                torch.set_num_threads(threads)
+                uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=[sock])
+            except BaseException:
+                logger.exception(f"Ошибка процесса сервиса {worker_idx}")
+                exit_code = 1
+            os._exit(exit_code)
+        children[pid] = worker_idx
+    logger.info(f"Запущено процессов сервиса: {workers}, потоков PyTorch на процесс: {threads}, "
+                f"адрес {host}:{port}")
+
+    stopping = False
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Неожиданное завершение любого процесса останавливает все остальные, чтобы сервис
+    # перезапускался целиком внешним супервизором
+    exit_code = 0
+    while children:
+        pid, wait_status = os.wait()
+        worker_idx = children.pop(pid, None)
+        if worker_idx is not None and not stopping:
+            logger.error(f"Процесс сервиса {worker_idx} завершился с кодом {os.waitstatus_to_exitcode(wait_status)}")
+            exit_code = 1
+            stop()
+    sock.close()
+    raise SystemExit(exit_code)
+
 # Запуск сервера
 if __name__ == "__main__":
-    uvicorn.run(app, host="localhost", port=8000)
+    serve("localhost", 8000, service_config_python.workers)
@@ -0,0 +1,70 @@
+import numpy as np
+from datacontract.service_output import DetectedObject, ServiceOutput
+from motion_gate import MotionGate
+
+
+def make_object(xtl, ytl, xbr, ybr, tracked_id, class_name="car"):
+    return DetectedObject(xtl=xtl, ytl=ytl, xbr=xbr, ybr=ybr, class_name=class_name, tracked_id=tracked_id)
+
+
+# Шаг с полным кадром: результат и опорный кадр заменяются целиком
+def full_step(gate, frame, objects):
+    height, width = frame.shape[:2]
+    region = gate.check(frame)
+    assert region == (0, 0, width, height)
+    return gate.update(frame, region, ServiceOutput(width=width, height=height, objects=objects))
+
+
+def test_unchanged_frame_reuses_output():
+    gate = MotionGate(width=64)
+    frame = np.zeros((64, 64, 3), dtype=np.uint8)
+    output = full_step(gate, frame, [make_object(0, 0, 10, 10, 0)])
+
+    assert gate.check(frame.copy()) is None
+    assert gate.output is output
+    assert gate.reused == 1
+
+
+def test_region_objects_are_offset_and_renumbered():
+    gate = MotionGate(width=64, max_region=1.0)
+    frame = np.zeros((64, 64, 3), dtype=np.uint8)
+    outside = make_object(0, 0, 8, 8, 0, "sign")
+    covered = make_object(50, 50, 60, 60, 1000)
+    full_step(gate, frame, [outside, covered])
+
+    changed = frame.copy()
+    changed[48:64, 48:64] = 255
+    region = gate.check(changed)
+    x1, y1, x2, y2 = region
+    assert (x1, y1) != (0, 0) and x2 == 64 and y2 == 64
+
+    # В области найдены два объекта с номерами, которые совпадают с номером оставленного объекта
+    found = [make_object(2, 2, 6, 6, 0), make_object(1, 1, 4, 4, 1)]
+    result = gate.update(changed, region, ServiceOutput(width=x2 - x1, height=y2 - y1, objects=found))
+
+    assert result.width == 64 and result.height == 64
+    assert result.objects[0] == outside
+    assert [(obj.xtl, obj.ytl, obj.xbr, obj.ybr) for obj in result.objects[1:]] == [
+        (x1 + 2, y1 + 2, x1 + 6, y1 + 6), (x1 + 1, y1 + 1, x1 + 4, y1 + 4)
+    ]
+    ids = [obj.tracked_id for obj in result.objects]
+    assert ids == [0, 1, 2]
+    assert gate.partial == 1
+
+
+def test_reference_updated_only_in_region():
+    gate = MotionGate(width=64, max_region=1.0)
+    frame = np.zeros((64, 64, 3), dtype=np.uint8)
+    full_step(gate, frame, [])
+
+    changed = frame.copy()
+    changed[48:64, 48:64] = 255
+    region = gate.check(changed)
+    gate.update(changed, region, ServiceOutput(width=64, height=64, objects=[]))
+
+    # Опорный кадр совпадает с новым кадром в области и со старым вне ее
+    x1, y1, x2, y2 = region
+    assert (gate.reference[y1:y2, x1:x2] == gate.small(changed)[y1:y2, x1:x2]).all()
+    assert (gate.reference[y1:y2, x1:x2] == 255).any()
+    assert (gate.reference[:y1] == 0).all() and (gate.reference[:, :x1] == 0).all()
+    assert gate.check(changed.copy()) is None
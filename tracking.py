@@ -0,0 +1,193 @@
+from collections import Counter
+from typing import Callable, Optional
+import cv2
+import numpy as np
+from norfair import Detection, Tracker
+from datacontract.service_output import DetectedObject, ServiceOutput
+
+# Сетка точек внутри рамки, по которым оценивается движение объекта
+FLOW_GRID = 5
+# Допустимое расхождение прямого и обратного оптического потока, пикселей
+FLOW_MAX_ERROR = 1.0
+# Ограничение изменения масштаба рамки между соседними кадрами
+FLOW_MAX_SCALE_STEP = 1.25
+
+
+# Трекинг объектов видеопотока между ключевыми кадрами.
+# Полный инференс (детекция + классификация) выполняется только на ключевых кадрах: раз в
+# keyframe_interval кадров или раньше, если уверенность трекинга упала ниже min_confidence.
+# На промежуточных кадрах рамки переносятся оптическим потоком, номера объектов ведет трекер
+# norfair, а класс объекта берется из истории трека без повторной классификации.
+# Состояние относится к одному потоку кадров, кадры подаются строго по порядку
+class KeyframeTracker:
+    def __init__(self, keyframe_interval: int = 10, min_confidence: float = 0.5,
+                 distance_threshold: float = 0.7, bgr: bool = False):
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.min_confidence = min_confidence
+        self.bgr = bgr
+        # Потерянный на ключевом кадре трек живет до двух интервалов, чтобы сохранить его номер
+        # при кратковременном пропуске детектором
+        self.tracker = Tracker(
+            distance_function="iou",
+            distance_threshold=distance_threshold,
+            hit_counter_max=2 * self.keyframe_interval,
+            initialization_delay=0
+        )
+        self.class_votes: dict[int, Counter] = {}
+        self.objects: list[DetectedObject] = []
+        # Рамки выданных объектов без округления, чтобы ошибка не накапливалась от кадра к кадру
+        self.boxes = np.empty((0, 4))
+        self.prev_gray = None
+        self.frames_since_keyframe = 0
+        self.keyframes = 0
+        self.frames = 0
+
+    def gray(self, frame: np.ndarray) -> np.ndarray:
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY if self.bgr else cv2.COLOR_RGB2GRAY)
+
+    # Один шаг трекинга; infer вызывается только для ключевых кадров
+    def step(self, frame: np.ndarray, infer: Callable[[np.ndarray], ServiceOutput]) -> ServiceOutput:
+        output = self.propagate(frame)
+        if output is None:
+            output = self.keyframe(frame, infer(frame))
+        return output
+
+    # Перенос рамок предыдущего кадра на текущий. Возвращает None, если нужен ключевой кадр
+    def propagate(self, frame: np.ndarray) -> Optional[ServiceOutput]:
+        if self.prev_gray is None or self.frames_since_keyframe + 1 >= self.keyframe_interval:
+            return None
+
+        gray = self.gray(frame)
+        if gray.shape != self.prev_gray.shape:
+            return None
+
+        boxes, confidences = flow_boxes(self.prev_gray, gray, self.boxes)
+        if len(confidences) and confidences.min() < self.min_confidence:
+            return None
+
+        detections = [
+            Detection(points=box.reshape(2, 2), label=category(obj.class_name), data=obj.class_name)
+            for obj, box in zip(self.objects, boxes)
+        ]
+        tracked = self.update(detections)
+        # Выдается рамка оптического потока: оценка фильтра Калмана до набора скорости трека отстает
+        self.set_objects(tracked, gray.shape)
+        self.prev_gray = gray
+        self.frames_since_keyframe += 1
+        self.frames += 1
+        return ServiceOutput(
+            width=frame.shape[1], height=frame.shape[0], channels=frame.shape[2], objects=list(self.objects)
+        )
+
+    # Ключевой кадр: результат полного инференса сопоставляется с треками
+    def keyframe(self, frame: np.ndarray, output: ServiceOutput) -> ServiceOutput:
+        detections = [
+            Detection(
+                points=np.array([[obj.xtl, obj.ytl], [obj.xbr, obj.ybr]], dtype=np.float64),
+                label=category(obj.class_name),
+                data=obj.class_name
+            )
+            for obj in output.objects
+            if obj.xbr > obj.xtl and obj.ybr > obj.ytl
+        ]
+        tracked = self.update(detections)
+
+        for obj, detection in tracked:
+            self.class_votes.setdefault(obj.id, Counter())[detection.data] += 1
+        # На ключевом кадре выдаются рамки детектора, номер и класс берутся из трека
+        self.set_objects(tracked, frame.shape)
+        self.prev_gray = self.gray(frame)
+        self.frames_since_keyframe = 0
+        self.keyframes += 1
+        self.frames += 1
+        return output.model_copy(update={"objects": list(self.objects)})
+
+    # Обновление трекера; возвращаются только треки, сопоставленные с переданными детекциями
+    def update(self, detections: list[Detection]) -> list[tuple]:
+        active = self.tracker.update(detections=detections)
+        detection_ids = {id(detection) for detection in detections}
+        tracked = [(obj, obj.last_detection) for obj in active if id(obj.last_detection) in detection_ids]
+
+        alive = {obj.id for obj in self.tracker.tracked_objects}
+        for track_id in list(self.class_votes):
+            if track_id not in alive:
+                del self.class_votes[track_id]
+        return tracked
+
+    # Класс трека - самый частый класс по его ключевым кадрам
+    def set_objects(self, tracked: list[tuple], shape: tuple):
+        self.boxes = np.array([detection.points.reshape(-1) for _, detection in tracked]).reshape(-1, 4)
+        self.objects = []
+        for (obj, detection), box in zip(tracked, self.boxes):
+            votes = self.class_votes.get(obj.id)
+            box = clip_box(box, shape)
+            self.objects.append(DetectedObject(
+                xtl=int(box[0]), ytl=int(box[1]),
+                xbr=int(box[2]), ybr=int(box[3]),
+                class_name=votes.most_common(1)[0][0] if votes else detection.data,
+                tracked_id=obj.id
+            ))
+
+
+# Машины и знаки сопоставляются с треками только внутри своей категории; конкретный
+# класс знака в сопоставлении не участвует, поэтому ошибка классификатора не рвет трек
+def category(class_name: str) -> str:
+    return "Car" if class_name == "Car" else "Sign"
+
+
+def clip_box(box: np.ndarray, shape: tuple) -> np.ndarray:
+    height, width = shape[:2]
+    return np.array([
+        np.clip(box[0], 0, width - 1), np.clip(box[1], 0, height - 1),
+        np.clip(box[2], 0, width - 1), np.clip(box[3], 0, height - 1)
+    ])
+
+
+# Перенос рамок оптическим потоком Лукаса-Канаде по сетке точек внутри каждой рамки.
+# Уверенность рамки - доля точек, прошедших проверку прямым и обратным потоком
+def flow_boxes(prev_gray: np.ndarray, gray: np.ndarray,
+               boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    if not len(boxes):
+        return np.empty((0, 4)), np.empty(0)
+
+    boxes = boxes.astype(np.float32)
+    # Сетка с отступом 10% от краев рамки, чтобы меньше захватывать фон
+    steps = np.linspace(0.1, 0.9, FLOW_GRID, dtype=np.float32)
+    grid_x, grid_y = np.meshgrid(steps, steps)
+    sizes = boxes[:, 2:] - boxes[:, :2]
+    points = np.stack([
+        boxes[:, None, 0] + grid_x.reshape(1, -1) * sizes[:, None, 0],
+        boxes[:, None, 1] + grid_y.reshape(1, -1) * sizes[:, None, 1]
+    ], axis=-1).reshape(-1, 1, 2)
+
+    forward, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None)
+    backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, forward, None)
+    error = np.linalg.norm(points - backward, axis=-1).reshape(len(boxes), -1)
+    valid = (status.reshape(len(boxes), -1) == 1) & (back_status.reshape(len(boxes), -1) == 1)
+    valid &= error < FLOW_MAX_ERROR
+
+    old_points = points.reshape(len(boxes), -1, 2)
+    new_points = forward.reshape(len(boxes), -1, 2)
+    height, width = gray.shape[:2]
+    new_boxes = boxes.copy()
+    confidences = valid.mean(axis=1)
+    for i in range(len(boxes)):
+        if valid[i].sum() < 3:
+            confidences[i] = 0.0
+            continue
+        old, new = old_points[i][valid[i]], new_points[i][valid[i]]
+        old_center, new_center = np.median(old, axis=0), np.median(new, axis=0)
+        old_spread = np.median(np.linalg.norm(old - old_center, axis=1))
+        new_spread = np.median(np.linalg.norm(new - new_center, axis=1))
+        scale = new_spread / old_spread if old_spread > 0 else 1.0
+        scale = np.clip(scale, 1 / FLOW_MAX_SCALE_STEP, FLOW_MAX_SCALE_STEP)
+
+        center = (boxes[i, :2] + boxes[i, 2:]) / 2 + (new_center - old_center)
+        half_size = sizes[i] * scale / 2
+        new_boxes[i] = np.concatenate([center - half_size, center + half_size])
+
+        # Объект, ушедший за край кадра, требует повторной детекции
+        if center[0] < 0 or center[1] < 0 or center[0] >= width or center[1] >= height:
+            confidences[i] = 0.0
+
+    return new_boxes.astype(np.float64), confidences